@@ -1,17 +1,25 @@
-from .models import SystemModel, BaseModel
+from .models import SystemModel, BaseModel, VersionedMixin
 from .errors import ServerError, Errors
 from .config import settings
 from .db import db, Base
-from .commands import Commands
 
 
 name = "platform"
 
 
+def __getattr__(attr):
+    # Commands is only needed by the command line, apps served by a process manager never import it
+    if attr == "Commands":
+        from .commands import Commands
+        return Commands
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, attr))
+
+
 __all__ = [
     "name",
     "SystemModel",
     "BaseModel",
+    "VersionedMixin",
     "ServerError",
     "Errors",
     "settings",
@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from inspect import isawaitable
+
+from .config import settings
+from .db import db
+from .errors import ServiceUnavailable
+
+
+class Limiter(object):
+    """
+    Lets at most `max_concurrency` requests in at once. Up to `max_queued` more wait, each for at most `timeout`
+    seconds. Anything beyond that is rejected with ServiceUnavailable straight away, which is cheap, instead of
+    joining a queue that would only make every request time out.
+    """
+
+    def __init__(self, max_concurrency, max_queued=None, timeout=None):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued if max_queued is not None else settings.ADMISSION_MAX_QUEUED
+        self.timeout = timeout if timeout is not None else settings.ADMISSION_QUEUE_TIMEOUT
+        self.waiting = 0
+        self.__semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use so that it belongs to the event loop of the worker process that serves requests
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.__semaphore
+
+    async def acquire(self):
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            return
+        if self.waiting >= self.max_queued:
+            raise ServiceUnavailable()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout or None)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailable()
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+
+global_limiter = None
+controller_limiters = {}
+handler_executor = None
+
+
+def get_global_limiter():
+    global global_limiter
+    if global_limiter is None and settings.ADMISSION_MAX_CONCURRENCY:
+        global_limiter = Limiter(settings.ADMISSION_MAX_CONCURRENCY)
+    return global_limiter
+
+
+def get_controller_limiter(controller):
+    """
+    The limiter shared by all requests to one controller class, from its `max_concurrency`, `max_queued` and
+    `queue_timeout` attributes.
+    """
+    controller_class = controller.__class__
+    if controller_class not in controller_limiters:
+        controller_limiters[controller_class] = Limiter(
+            controller.max_concurrency,
+            max_queued=controller.max_queued,
+            timeout=controller.queue_timeout
+        )
+    return controller_limiters[controller_class]
+
+
+def is_limited(controller):
+    return bool(settings.ADMISSION_MAX_CONCURRENCY) or controller.max_concurrency is not None
+
+
+def get_handler_executor():
+    """
+    The threads that run the handlers of limited requests, as many as ADMISSION_MAX_CONCURRENCY allows in at once.
+    Created on first use, in the worker process that serves requests.
+    """
+    global handler_executor
+    if handler_executor is None:
+        handler_executor = ThreadPoolExecutor(
+            max_workers=settings.ADMISSION_MAX_CONCURRENCY or None,
+            thread_name_prefix="handler"
+        )
+    return handler_executor
+
+
+async def run_handler(handler, *args, **kwargs):
+    """
+    Runs a sync handler in a thread of its own with its own DB session. Handlers that ran on the event loop would
+    run one at a time: the limiters would never have anyone to queue and the DB pool could never be saturated.
+    """
+    def run():
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            db.remove_session()
+
+    context = contextvars.copy_context()
+    response = await asyncio.get_event_loop().run_in_executor(get_handler_executor(), context.run, run)
+    if isawaitable(response):
+        response = await response
+    return response
+
+
+def reset_after_fork():
+    # The threads of the parent are not in the child
+    global handler_executor
+    handler_executor = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def is_pool_saturated():
+    """
+    True when every connection the pool may open is checked out, so a new checkout would wait for one.
+    Only pools with a fixed size (QueuePool, the default) can be saturated.
+    """
+    pool = db.engine.pool
+    max_overflow = getattr(pool, "_max_overflow", -1)
+    if max_overflow < 0 or not hasattr(pool, "checkedout"):
+        return False
+    return pool.checkedout() >= pool.size() + max_overflow
+
+
+def check_request(request):
+    """
+    Rejects a request that already waited longer than ADMISSION_QUEUE_TIMEOUT before we got to it, which means the
+    event loop is behind, or that would have to wait for a DB connection.
+    :raises ServiceUnavailable:
+    """
+    received_at = getattr(request, "received_at", None)
+    if (settings.ADMISSION_QUEUE_TIMEOUT and received_at is not None and
+            time.monotonic() - received_at > settings.ADMISSION_QUEUE_TIMEOUT):
+        raise ServiceUnavailable()
+    if settings.ADMISSION_SHED_ON_POOL_SATURATION and is_pool_saturated():
+        raise ServiceUnavailable()
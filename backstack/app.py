@@ -1,25 +1,68 @@
-from sanic import Sanic
+from sanic import Sanic, response
 from sanic.request import Request
-from sanic.response import json
 from sanic.exceptions import SanicException
 import importlib
+import time
 
 from .singleton import Singleton
 from .auth import auth
 from .config import settings
-from .errors import ModelError
-from .middlewares import session_middlewares, cors_middlewares
+from .errors import ModelError, PreconditionFailed, ServiceUnavailable
+from .middlewares import (
+    metrics_middlewares, admission_middlewares, compression_middlewares, nplusone_middlewares, session_middlewares,
+    cors_middlewares
+)
+from .admission import check_request, get_global_limiter
+from .json_codec import dumps_bytes, json_response, loads
+from .registry import build_registry
 
 
 class MainApp(Sanic, metaclass=Singleton):
+    # Health checks and metrics are never shed, see `handle_request`
+    admission_exempt_paths = ("/api/_ready", "/api/_metrics")
+
     def setup_routes(self):
+        # app name => seconds spent importing its urls and setting up its routes, see `Commands.profile_startup`
+        self.startup_timings = {}
         for app in settings.APPS:
+            start = time.perf_counter()
             try:
                 urls = importlib.import_module("apps.%s.urls" % app)
                 if hasattr(urls, "setup_routes"):
                     urls.setup_routes(self)
             except ImportError as e:
                 print("In app {}:".format(app), e)
+            self.startup_timings[app] = time.perf_counter() - start
+
+    async def handle_request(self, request, write_callback, stream_callback):
+        """
+        Admission control, see backstack.admission. A request that is not admitted still goes through the
+        middlewares, where `admission_middlewares` turns its error into the response, so that CORS and the other
+        response middlewares apply to it. Without `admission_middlewares` such a request is handled as usual.
+        """
+        if request.path.startswith(self.admission_exempt_paths):
+            return await super().handle_request(request, write_callback, stream_callback)
+
+        limiter = get_global_limiter()
+        try:
+            check_request(request)
+            if limiter is not None:
+                await limiter.acquire()
+        except ServiceUnavailable as e:
+            request.admission_error = e
+            return await super().handle_request(request, write_callback, stream_callback)
+
+        try:
+            return await super().handle_request(request, write_callback, stream_callback)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def register_middleware(self, middleware, attach_to="request"):
+        if settings.METRICS_ENABLED and not getattr(middleware, "untimed", False):
+            from .metrics import timed_middleware
+            middleware = timed_middleware(middleware)
+        return super().register_middleware(middleware, attach_to=attach_to)
 
     def add_route(self, *args, **kwargs):
         # Prepend /api to all API URLs by default
@@ -62,7 +105,22 @@ def json_exception(request, exception):
         errors["_model"] = {}
         errors["_model"][exception.field] = exception.message
 
-    return json(errors, status=status_code)
+    if isinstance(exception, PreconditionFailed):
+        # Sanic drops Content-Length from a 412, so the body is sent chunked to be delimited
+        body = dumps_bytes(errors)
+
+        async def streaming_fn(resp):
+            await resp.write(body)
+        return response.stream(streaming_fn, status=status_code, content_type="application/json")
+    if isinstance(exception, ServiceUnavailable):
+        return json_response(errors, status=status_code, headers={"Retry-After": str(exception.retry_after)})
+    return json_response(errors, status=status_code)
+
+
+def ready_view(request):
+    if getattr(request.app, "ready", False):
+        return json_response({"ready": True})
+    return json_response({"ready": False}, status=503)
 
 
 class CustomRequest(Request):
@@ -71,6 +129,14 @@ class CustomRequest(Request):
         self.user = None
         self.session = None
         self.__client_ip = None
+        # Requests are created as soon as their headers are read, admission control uses this to tell how long
+        # they waited for the event loop
+        self.received_at = time.monotonic()
+        self.admission_error = None
+
+    def load_json(self, loads=loads):
+        # Request bodies are parsed with JSON_BACKEND too
+        return super().load_json(loads=loads)
 
     @property
     def is_authenticated(self):
@@ -90,7 +156,10 @@ class CustomRequest(Request):
 def create_app(
         override_settings=None,
         app_class=MainApp,
-        middlewares=(session_middlewares, cors_middlewares),
+        middlewares=(
+            metrics_middlewares, admission_middlewares, compression_middlewares, nplusone_middlewares,
+            cors_middlewares, session_middlewares
+        ),
         request_class=CustomRequest
 ):
     if override_settings:
@@ -102,6 +171,25 @@ def create_app(
     for middleware in middlewares:
         middleware(app)
     app.setup_routes()
+    build_registry()
+    # The optional features are only imported when they are turned on, like sqlalchemy-migrate by the migrate command
+    if settings.WARMUP_ENABLED:
+        from .warmup import setup_warmup
+        setup_warmup(app)
+    else:
+        app.ready = True
+    app.add_route(ready_view, "/_ready")
+    if settings.BATCH_ENABLED:
+        from .batch import batch_view
+        app.add_route(batch_view, "/_batch", methods=["POST"])
+    if settings.METRICS_ENABLED and settings.METRICS_TOKEN:
+        from .metrics import metrics_view
+        app.add_route(metrics_view, "/_metrics")
+    if settings.SQL_STATS_ENABLED:
+        from .sqlstats import setup_statement_tracking, sql_stats_view
+        setup_statement_tracking()
+        if settings.METRICS_TOKEN:
+            app.add_route(sql_stats_view, "/_metrics/sql")
 
     app.error_handler.add(SanicException, json_exception)
     app.error_handler.add(ModelError, json_exception)
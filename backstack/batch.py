@@ -0,0 +1,248 @@
+import asyncio
+import contextvars
+from inspect import isawaitable
+from sanic.compat import Header
+from sanic.exceptions import SanicException
+from sanic.response import StreamingHTTPResponse
+
+from .config import settings
+from .db import db
+from .errors import ServerError, Errors
+from .cache import cache, deferred_tables
+from . import json_codec
+from .json_codec import json_response
+
+
+READ_METHODS = ("GET", "HEAD")
+METHODS = READ_METHODS + ("POST", "PUT", "PATCH", "DELETE")
+
+
+def invalid_input(field):
+    return ServerError({"_schema": {field: [Errors.INVALID_INPUT.value]}}, status_code=400)
+
+
+def make_sub_request(parent, item):
+    """
+    A request for one item of a batch, with the headers of the batch request (cookies, Authorization, ...) and
+    its own method, path, headers and JSON body.
+    """
+    if not isinstance(item, dict):
+        raise invalid_input("requests")
+    method = str(item.get("method", "GET")).upper()
+    path = item.get("path", None)
+    if method not in METHODS or not isinstance(path, str) or not path.startswith("/"):
+        raise invalid_input("requests")
+
+    headers = Header((k, v) for k, v in parent.headers.items() if k.lower() not in ("content-length", "content-type"))
+    for key, value in (item.get("headers", None) or {}).items():
+        headers[key] = str(value)
+    request = parent.app.request_class(path.encode("utf-8"), headers, parent.version, method, parent.transport,
+                                       parent.app)
+    if item.get("body", None) is not None:
+        headers["Content-Type"] = "application/json"
+        request.body = json_codec.dumps_bytes(item["body"])
+    else:
+        request.body = b""
+    request.conn_info = parent.conn_info
+    # The session and the user were loaded once by the middlewares of the batch request, the sub-requests share them
+    request.session = getattr(parent, "session", None)
+    request.user = getattr(parent, "user", None)
+    # Handled in the thread of the batch, see `BaseController.dispatch_request`
+    request.in_batch = True
+    if is_batch_request(request):
+        # A batch in a batch would multiply the sub-requests of one request
+        raise invalid_input("requests")
+    return request
+
+
+def is_batch_request(request):
+    """
+    True when the path of a request is routed to the batch view, whatever its spelling ("/api/_batch/", ...).
+    """
+    try:
+        handler = request.app.router.get(request)[0]
+    except SanicException:
+        return False
+    return handler is batch_view
+
+
+def call_handler(request):
+    """
+    Routes a sub-request and calls its handler, the middlewares already ran for the batch request.
+    Returns a response or an awaitable of one.
+    """
+    handler, args, kwargs, uri, name, endpoint = request.app.router.get(request)
+    request.uri_template = uri
+    request.endpoint = endpoint
+    return handler(request, *args, **kwargs)
+
+
+def wait_for(result):
+    """
+    The result of a handler, async handlers run to completion on an event loop of the calling thread.
+    """
+    if not isawaitable(result):
+        return result
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(result)
+    finally:
+        loop.close()
+
+
+def handle(request):
+    """
+    Runs a sub-request and returns its response as a dict, errors are turned into responses by the error handler.
+    """
+    try:
+        result = wait_for(call_handler(request))
+    except Exception as e:
+        result = wait_for(request.app.error_handler.response(request, e))
+    return as_dict(result)
+
+
+def handle_in_thread(request):
+    try:
+        return handle(request)
+    finally:
+        # Each thread has its own scoped session, give its connection back to the pool
+        db.remove_session()
+
+
+async def run_in_thread(function, *args):
+    """
+    Runs `function` in a thread of the default executor, so that the DB session of the loop thread is never used,
+    nor kept open while the loop handles other requests.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, context.run, function, *args)
+
+
+async def run(request):
+    return await run_in_thread(handle_in_thread, request)
+
+
+class BodyCollector(object):
+    """
+    Stands for the response that a streaming function writes to, and keeps what it writes.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, data):
+        self.chunks.append(data.encode("utf-8") if isinstance(data, str) else data)
+
+
+async def read_stream(result):
+    collector = BodyCollector()
+    await result.streaming_fn(collector)
+    return b"".join(collector.chunks)
+
+
+def as_dict(result):
+    if isinstance(result, StreamingHTTPResponse):
+        # Streamed errors, like the 412 of a stale If-Match, are short: they are read in full. Other streams, like
+        # exports, cannot be part of a batch response
+        if result.status < 400:
+            return dict(status=400, headers={}, body={"__global__": Errors.INVALID_INPUT.value})
+        body = wait_for(read_stream(result))
+    else:
+        body = result.body or b""
+    if body and (result.content_type or "").startswith("application/json"):
+        body = json_codec.loads(body)
+    else:
+        body = body.decode("utf-8", "replace")
+    return dict(status=result.status, headers=dict(result.headers), body=body)
+
+
+async def run_reads(requests):
+    """
+    Runs reads concurrently, each in a thread of the default executor with its own DB session.
+    """
+    semaphore = asyncio.Semaphore(settings.BATCH_MAX_CONCURRENCY)
+
+    async def limited(request):
+        async with semaphore:
+            return await run(request)
+
+    return await asyncio.gather(*[limited(r) for r in requests])
+
+
+def run_transaction(requests):
+    """
+    Runs every sub-request in order in one DB transaction, each in a savepoint so that the commit of a controller
+    only releases its savepoint. The transaction is committed only when every sub-request succeeded, the ones after
+    a failure are not run. The cache versions of the written tables are bumped once it is committed, not when a
+    savepoint is released, so that no other request caches what it read before the commit.
+    """
+    results = []
+    committed = False
+    written_tables = set()
+    token = deferred_tables.set(written_tables)
+    try:
+        for request in requests:
+            savepoint = db.session.begin_nested()
+            result = handle(request)
+            if savepoint.is_active:
+                if result["status"] < 400:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+            results.append(result)
+            if result["status"] >= 400:
+                break
+        else:
+            db.session.commit()
+            committed = True
+    finally:
+        if not committed:
+            db.session.rollback()
+        deferred_tables.reset(token)
+        db.remove_session()
+    if committed:
+        cache.bump_version(*written_tables)
+    return results, committed
+
+
+async def run_in_transaction(requests):
+    # The whole transaction runs in one thread, with a DB session of its own
+    return await run_in_thread(run_transaction, requests)
+
+
+async def batch_view(request):
+    """
+    Runs several API calls in one round trip. The body is like:
+
+        {"requests": [{"method": "GET", "path": "/api/things?page=2"},
+                      {"method": "POST", "path": "/api/things", "body": {"name": "Thing"}}],
+         "transaction": false}
+
+    The response holds the status, headers and body of each sub-request, in order. Consecutive reads run
+    concurrently, writes run one after the other, all of them in threads of the default executor. With "transaction": true everything runs in order in one DB
+    transaction which is committed only if all of them succeed, "committed" tells which happened.
+    """
+    data = request.json
+    if not isinstance(data, dict) or not isinstance(data.get("requests", None), list):
+        raise invalid_input("requests")
+    if len(data["requests"]) > settings.BATCH_MAX_REQUESTS:
+        raise invalid_input("requests")
+    requests = [make_sub_request(request, item) for item in data["requests"]]
+
+    if data.get("transaction", False):
+        results, committed = await run_in_transaction(requests)
+        return json_response({"responses": results, "committed": committed})
+
+    results = []
+    reads = []
+    for sub_request in requests:
+        if sub_request.method in READ_METHODS:
+            reads.append(sub_request)
+            continue
+        if reads:
+            results.extend(await run_reads(reads))
+            reads = []
+        results.append(await run(sub_request))
+    if reads:
+        results.extend(await run_reads(reads))
+    return json_response({"responses": results})
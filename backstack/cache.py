@@ -0,0 +1,348 @@
+import asyncio
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pymemcache.client.base import Client
+from pymemcache.exceptions import MemcacheError
+from sqlalchemy import Table
+from sqlalchemy.sql.util import find_tables
+
+from .config import settings
+from .db import db
+from . import json_codec
+from .singleton import Singleton
+
+
+# A set while the written tables must be bumped only once an outer transaction is committed, see `batch`
+deferred_tables = contextvars.ContextVar("deferred_tables", default=None)
+
+
+class LRUCache(object):
+    """
+    A small in-process cache with a maximum number of entries and a timeout per entry.
+    `None` is never cached since `get` uses it to signal a miss.
+    Entries can be tagged, e.g. with the tables they were read from, to delete them together. It is thread safe.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__data = OrderedDict()
+        self.__tagged = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            try:
+                expires_at, value, tags = self.__data[key]
+            except KeyError:
+                return None
+            if expires_at < time.monotonic():
+                self.__remove(key)
+                return None
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout, tags=()):
+        with self.__lock:
+            self.__remove(key)
+            self.__data[key] = (time.monotonic() + timeout, value, tuple(tags))
+            for tag in tags:
+                self.__tagged.setdefault(tag, set()).add(key)
+            while len(self.__data) > self.max_size:
+                self.__remove(next(iter(self.__data)))
+
+    def delete(self, key):
+        with self.__lock:
+            self.__remove(key)
+
+    def delete_tagged(self, tag):
+        with self.__lock:
+            for key in list(self.__tagged.get(tag, ())):
+                self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.__tagged.clear()
+
+    def __remove(self, key):
+        entry = self.__data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.__tagged.get(tag, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__tagged[tag]
+
+
+async def compute_in_thread(compute):
+    """
+    Runs `compute()` in a thread of the default executor with a DB session of its own, so that the event loop
+    handles other requests (and the ones waiting for this value) meanwhile.
+    """
+    def run():
+        try:
+            return compute()
+        finally:
+            db.remove_session()
+
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, context.run, run)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key so that only the first one runs and the others share its result.
+    The others wait on a future of the event loop, they never block it.
+    """
+
+    def __init__(self):
+        self.__calls = {}
+
+    async def do(self, key, compute):
+        """
+        :param compute: Coroutine function that creates the value
+        """
+        loop = asyncio.get_event_loop()
+        # Batch sub-requests run on event loops of their own, a future can only be awaited on its loop
+        call_key = (id(loop), key)
+        call = self.__calls.get(call_key, None)
+        if call is not None:
+            return await asyncio.shield(call)
+
+        call = self.__calls[call_key] = loop.create_future()
+        try:
+            value = await compute()
+        except Exception as e:
+            call.set_exception(e)
+            # Mark the exception as retrieved when nobody else waited for it
+            call.exception()
+            raise
+        else:
+            call.set_result(value)
+            return value
+        finally:
+            del self.__calls[call_key]
+
+
+class QueryCache(object, metaclass=Singleton):
+    """
+    Two tier cache for query results: an in-process LRU in front of memcached.
+
+    Every table has a version counter in memcached which is part of each cache key, so bumping the version of a table
+    (which we do whenever we write to it) makes all cached results that read from it unreachable.
+    When memcached is not reachable nothing is cached and results are always computed.
+
+    Entries are kept for `stale_timeout` seconds after they expire. When an entry is stale, or missing, one request
+    across all workers takes a lock in memcached and recomputes it while the others serve the stale value (or wait
+    up to CACHE_LOCK_WAIT seconds for the fresh one), so an expiry does not send every request to the database.
+    Values are computed in executor threads and waiting is done with asyncio, the event loop is never blocked.
+    Memcached is only ever called from a thread of its own, the client is not thread safe and its calls would block
+    the event loop for up to CACHE_CONNECT_TIMEOUT seconds when memcached is down.
+    Nothing is done without CACHE_ENABLED.
+    """
+    __client = None
+    __local = None
+    __single_flight = None
+    __executor = None
+
+    @property
+    def local(self):
+        if self.__local is None:
+            self.__local = LRUCache(settings.CACHE_LOCAL_SIZE)
+        return self.__local
+
+    @property
+    def single_flight(self):
+        if self.__single_flight is None:
+            self.__single_flight = SingleFlight()
+        return self.__single_flight
+
+    @property
+    def executor(self):
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memcached")
+        return self.__executor
+
+    async def call(self, function, *args):
+        """
+        Runs `function(*args)`, which calls memcached, in the memcached thread while the event loop goes on.
+        """
+        return await asyncio.wrap_future(self.executor.submit(function, *args))
+
+    def client(self):
+        if self.__client is None:
+            self.__client = Client(
+                (settings.MEMCACHED_HOST, 11211),
+                connect_timeout=settings.CACHE_CONNECT_TIMEOUT,
+                timeout=settings.CACHE_CONNECT_TIMEOUT
+            )
+        return self.__client
+
+    def reset_after_fork(self):
+        self.__client = None
+        self.__single_flight = None
+        # The thread of the parent is not in the child
+        self.__executor = None
+
+    @staticmethod
+    def version_key(table):
+        return "ver/%s" % table
+
+    @staticmethod
+    def initial_version():
+        # If memcached evicted a counter we must not start again from a number that was used before
+        return int(time.time() * 1000)
+
+    def get_versions(self, tables):
+        tables = sorted(tables)
+        keys = [self.version_key(t) for t in tables]
+        found = self.client().get_many(keys)
+        versions = []
+        for key in keys:
+            if key not in found:
+                # If someone else created the counter in the meantime our add does nothing and we read theirs
+                self.client().add(key, str(self.initial_version()), noreply=False)
+                found[key] = self.client().get(key)
+            versions.append(int(found[key]))
+        return tuple(versions)
+
+    def bump_version(self, *tables):
+        """
+        Invalidates what was cached from `tables`. Handler threads wait for memcached, the event loop does not: it
+        drops the entries of this process at once and lets the memcached thread bump the versions.
+        """
+        if not settings.CACHE_ENABLED:
+            return
+        deferred = deferred_tables.get()
+        if deferred is not None:
+            # Bumped by whoever set `deferred_tables`, once its transaction is committed
+            deferred.update(tables)
+            return
+        tables = set(tables)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.executor.submit(self.__bump, tables).result()
+            return
+        for table in tables:
+            self.local.delete_tagged(table)
+        self.executor.submit(self.__bump, tables)
+
+    def __bump(self, tables):
+        for table in tables:
+            key = self.version_key(table)
+            try:
+                if self.client().incr(key, 1, noreply=False) is None:
+                    self.client().add(key, str(self.initial_version()), noreply=False)
+            except (MemcacheError, OSError) as e:
+                print("Could not bump the cache version of table {}:".format(table), e)
+                # At least this process must not serve what it cached from the table before the write
+                self.local.delete_tagged(table)
+
+    @staticmethod
+    def make_key(*parts):
+        return "qc/%s" % hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    async def get_or_set(self, key_parts, tables, compute, timeout=None, stale_timeout=None):
+        """
+        Returns the cached value for `key_parts` or stores the result of `compute()` in both tiers.
+        :param key_parts: Anything with a stable repr() that identifies the value
+        :param tables: Names of the tables that the value is read from
+        :param compute: Callable that creates the value on a cache miss, it runs in an executor thread
+        """
+        timeout = timeout or settings.CACHE_DEFAULT_TIMEOUT
+        if stale_timeout is None:
+            stale_timeout = settings.CACHE_STALE_TIMEOUT
+        try:
+            key = self.make_key(key_parts, await self.call(self.get_versions, tables))
+        except (MemcacheError, OSError):
+            return await self.single_flight.do(self.make_key(key_parts), lambda: compute_in_thread(compute))
+
+        return await self.single_flight.do(
+            key, lambda: self.__get_or_refresh(key, tables, compute, timeout, stale_timeout)
+        )
+
+    async def __get_or_refresh(self, key, tables, compute, timeout, stale_timeout):
+        entry = self.local.get(key)
+        if entry is None:
+            entry = await self.call(self.__get_remote, key)
+            if entry is not None:
+                self.local.set(key, entry, timeout + stale_timeout, tables)
+
+        if entry is not None:
+            value, fresh_until = entry
+            if fresh_until > time.time() or not await self.call(self.__lock, key):
+                # Either fresh, or stale while some other request is refreshing it
+                return value
+            return await self.__refresh(key, tables, compute, timeout, stale_timeout)
+
+        if await self.call(self.__lock, key):
+            return await self.__refresh(key, tables, compute, timeout, stale_timeout)
+
+        # Some other worker is computing this value, wait for it before we give up and compute it ourselves
+        deadline = time.monotonic() + settings.CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.CACHE_LOCK_POLL_INTERVAL)
+            entry = await self.call(self.__get_remote, key)
+            if entry is not None:
+                self.local.set(key, entry, timeout + stale_timeout, tables)
+                return entry[0]
+        return await self.__refresh(key, tables, compute, timeout, stale_timeout, locked=False)
+
+    def __get_remote(self, key):
+        try:
+            cached = self.client().get(key)
+        except (MemcacheError, OSError):
+            return None
+        return json_codec.loads(cached) if cached is not None else None
+
+    def __lock(self, key):
+        try:
+            return self.client().add("lock/%s" % key, "1", expire=settings.CACHE_LOCK_TIMEOUT, noreply=False)
+        except (MemcacheError, OSError):
+            return True
+
+    async def __refresh(self, key, tables, compute, timeout, stale_timeout, locked=True):
+        try:
+            entry = [await compute_in_thread(compute), time.time() + timeout]
+            self.local.set(key, entry, timeout + stale_timeout, tables)
+            await self.call(self.__store, key, entry, timeout + stale_timeout)
+            return entry[0]
+        finally:
+            if locked:
+                await self.call(self.__unlock, key)
+
+    def __store(self, key, entry, expire):
+        try:
+            self.client().set(key, json_codec.dumps_bytes(entry), expire=expire)
+        except (MemcacheError, OSError):
+            pass
+
+    def __unlock(self, key):
+        try:
+            self.client().delete("lock/%s" % key)
+        except (MemcacheError, OSError):
+            pass
+
+
+def query_key(query):
+    """
+    The compiled SQL of a query along with its parameters, which together identify its result.
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    return str(compiled), sorted((k, repr(v)) for k, v in compiled.params.items())
+
+
+def query_tables(query):
+    return set(t.name for t in find_tables(query.statement, include_joins=True) if isinstance(t, Table))
+
+
+cache = QueryCache()
+os.register_at_fork(after_in_child=cache.reset_after_fork)
@@ -0,0 +1,106 @@
+import importlib
+
+from .config import settings
+from . import json_codec
+
+
+def import_optional(module_name, purpose):
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise Exception("You have to install {} to use it for {},"
+                        " see documentation for ERROR_CODECS_REQUIREMENTS".format(module_name, purpose))
+
+
+class JSONCodec(object):
+    content_type = "application/json"
+
+    def encode(self, data):
+        return json_codec.dumps_bytes(data)
+
+    def decode(self, payload):
+        return json_codec.loads(payload)
+
+
+class MsgpackCodec(object):
+    content_type = "application/msgpack"
+
+    def encode(self, data):
+        return import_optional("msgpack", "queue messages").packb(data, use_bin_type=True)
+
+    def decode(self, payload):
+        return import_optional("msgpack", "queue messages").unpackb(payload, raw=False)
+
+
+class ZstdCompressor(object):
+    content_encoding = "zstd"
+
+    def compress(self, payload):
+        return import_optional("zstandard", "queue messages").ZstdCompressor().compress(payload)
+
+    def decompress(self, payload):
+        return import_optional("zstandard", "queue messages").ZstdDecompressor().decompress(payload)
+
+
+class LZ4Compressor(object):
+    content_encoding = "lz4"
+
+    def compress(self, payload):
+        return import_optional("lz4.frame", "queue messages").compress(payload)
+
+    def decompress(self, payload):
+        return import_optional("lz4.frame", "queue messages").decompress(payload)
+
+
+content_types = {}
+content_encodings = {}
+
+
+def register_content_type(codec):
+    content_types[codec.content_type] = codec
+
+
+def register_content_encoding(compressor):
+    content_encodings[compressor.content_encoding] = compressor
+
+
+register_content_type(JSONCodec())
+register_content_type(MsgpackCodec())
+register_content_encoding(ZstdCompressor())
+register_content_encoding(LZ4Compressor())
+
+
+def encode(data, content_type=None, content_encoding=None):
+    """
+    Encodes a queue message. The payload is compressed only when it is larger than QUEUE_COMPRESSION_THRESHOLD.
+    :return: A tuple of the payload (bytes) and the AMQP properties that describe it
+    """
+    content_type = content_type or settings.QUEUE_CONTENT_TYPE
+    content_encoding = content_encoding or settings.QUEUE_CONTENT_ENCODING
+    payload = content_types[content_type].encode(data)
+    properties = {
+        "content_type": content_type,
+    }
+
+    if content_encoding and len(payload) > settings.QUEUE_COMPRESSION_THRESHOLD:
+        payload = content_encodings[content_encoding].compress(payload)
+        properties["content_encoding"] = content_encoding
+    return payload, properties
+
+
+def decode(payload, content_type=None, content_encoding=None):
+    """
+    Decodes a queue message using the AMQP `content_type` and `content_encoding` properties it was published with.
+    Messages without a `content_type` are treated as JSON, which is what we always published before.
+    """
+    if content_encoding:
+        try:
+            payload = content_encodings[content_encoding].decompress(payload)
+        except KeyError:
+            raise Exception("Unknown content encoding {} in queue message".format(content_encoding))
+
+    try:
+        codec = content_types[content_type or JSONCodec.content_type]
+    except KeyError:
+        raise Exception("Unknown content type {} in queue message".format(content_type))
+    return codec.decode(payload)
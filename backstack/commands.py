@@ -1,10 +1,11 @@
 import importlib
 import argparse
-from migrate.versioning.shell import main as migrations
-from migrate.exceptions import DatabaseAlreadyControlledError
+import time
+from functools import wraps
 
 from .db import db, Base
 from .config import settings
+from . import codecs, json_codec
 
 
 class Commands(object):
@@ -12,7 +13,8 @@ class Commands(object):
     __args = None
     __app_creator = None
     commands = [
-        "server", "load_fixtures", "load_fakes", "run_workers", "shell", "migrations"
+        "server", "load_fixtures", "load_fakes", "run_workers", "relay_outbox", "sql_stats", "profile_startup",
+        "shell", "migrations"
     ]
 
     def __init__(self, app_creator=None):
@@ -61,6 +63,22 @@ class Commands(object):
             except ImportError:
                 pass
 
+    @staticmethod
+    def decoded(callback):
+        """
+        Wraps a worker callback so that it receives the decoded message instead of the raw body.
+        The codec is picked from the `content_type` and `content_encoding` properties of each message.
+        """
+        @wraps(callback)
+        async def inner(channel, body, envelope, properties):
+            data = codecs.decode(
+                body,
+                content_type=properties.content_type,
+                content_encoding=properties.content_encoding
+            )
+            return await callback(channel, data, envelope, properties)
+        return inner
+
     async def run_workers(self, all_workers):
         import aioamqp
         try:
@@ -90,7 +108,7 @@ class Commands(object):
                         routing_key=key
                     )
                 await channel.basic_consume(
-                    callback=binding[0],
+                    callback=self.decoded(binding[0]),
                     queue_name=queue_name,
                     no_ack=binding[2]
                 )
@@ -137,11 +155,86 @@ class Commands(object):
                     print("It seems that the RabbitMQ exchange {} does not exist,"
                           " perhaps nothing has been published to it".format(settings.get_mq_exchange_name()))
 
+    def relay_outbox(self):
+        try:
+            import asyncio
+        except ImportError:
+            raise Exception("You have to install asyncio to run workers,"
+                            " see documentation for ERROR_WORKERS_REQUIREMENTS")
+
+        from .outbox import relay
+        self.init_app()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(relay())
+
     def server(self):
-        self.app.go_fast(**settings.DAEMON)
+        workers = self.__args.workers if self.__args is not None and self.__args.workers else settings.DAEMON_WORKERS
+        if workers > 1:
+            from .prefork import PreforkServer
+            PreforkServer(self.app, workers, **settings.DAEMON).run()
+        else:
+            self.app.go_fast(**settings.DAEMON)
+
+    @staticmethod
+    def sql_stats(sub_commands):
+        """
+        Prints the statements of a running server that took the most time in total, from /api/_metrics/sql.
+        Optional sub command: the number of statements to show.
+        """
+        from urllib.request import Request, urlopen
+
+        limit = sub_commands[0] if sub_commands else 20
+        url = "http://{}:{}/api/_metrics/sql?limit={}".format(settings.DAEMON["host"], settings.DAEMON["port"], limit)
+        request = Request(url, headers={"Authorization": "Bearer {}".format(settings.METRICS_TOKEN)})
+        try:
+            with urlopen(request) as f:
+                statements = json_codec.loads(f.read())
+        except OSError as e:
+            print("Could not read SQL statistics from {}, is the server running with SQL_STATS_ENABLED and"
+                  " METRICS_TOKEN?".format(url), e)
+            return
+
+        for stats in statements:
+            print("{id}  calls={calls}  total={total_ms}ms  mean={mean_ms}ms  p95={p95_ms}ms  rows={rows}".format(**stats))
+            print("    {}".format(stats["statement"]))
+            for route, route_stats in sorted(stats["routes"].items(), key=lambda r: -r[1]["total_ms"]):
+                print("    {}  calls={calls}  total={total_ms}ms  p95={p95_ms}ms".format(route, **route_stats))
+            if stats["plan"]:
+                print("    " + stats["plan"].replace("\n", "\n    "))
+            print()
+
+    def profile_startup(self):
+        """
+        Prints where startup time goes: the slowest imports of `backstack` in a fresh interpreter, then how long
+        `create_app` takes, split by app and by the modules it imports.
+        """
+        from .profiling import ImportTimer, measure_imports
+
+        print("Importing backstack (cumulative / self):")
+        for name, self_time, cumulative in measure_imports("backstack"):
+            print("  {:>8.1f}ms {:>8.1f}ms  {}".format(cumulative * 1000, self_time * 1000, name))
+
+        with ImportTimer() as timer:
+            start = time.perf_counter()
+            self.init_app()
+            total = time.perf_counter() - start
+        print()
+        print("create_app: {:.1f}ms".format(total * 1000))
+        timings = getattr(self.__app, "startup_timings", {})
+        for app, duration in sorted(timings.items(), key=lambda t: t[1], reverse=True):
+            print("  {:>8.1f}ms  apps.{}".format(duration * 1000, app))
+
+        print()
+        print("Slowest imports during create_app (cumulative / self):")
+        for name, (self_time, cumulative) in timer.slowest():
+            print("  {:>8.1f}ms {:>8.1f}ms  {}".format(cumulative * 1000, self_time * 1000, name))
 
     @staticmethod
     def migrations(sub_commands):
+        # sqlalchemy-migrate is slow to import and only needed here
+        from migrate.versioning.shell import main as migrations
+        from migrate.exceptions import DatabaseAlreadyControlledError
+
         try:
             migrations(
                 sub_commands,
@@ -172,6 +265,13 @@ class Commands(object):
             action="store",
             nargs="*"
         )
+        parser.add_argument(
+            "--workers",
+            action="store",
+            type=int,
+            default=None,
+            help="Number of server processes to pre-fork"
+        )
 
         args = parser.parse_args()
         self.__args = args
@@ -179,7 +279,7 @@ class Commands(object):
         if args.action in self.get_commands() and hasattr(self, args.action):
             if args.action == "run_workers":
                 self.manage_workers()
-            elif args.action == "migrations":
+            elif args.action in ("migrations", "sql_stats"):
                 getattr(self, args.action)(args.sub_commands)
             else:
                 getattr(self, args.action)()
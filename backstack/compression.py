@@ -0,0 +1,192 @@
+import zlib
+
+from .codecs import import_optional
+from .config import settings
+
+
+class GzipCompressor(object):
+    content_encoding = "gzip"
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, body):
+        compressor = self.stream()
+        return compressor.compress(body) + compressor.finish()
+
+    def stream(self):
+        return GzipStream(self.level)
+
+
+class GzipStream(object):
+    def __init__(self, level):
+        # wbits of 31 writes the gzip header and trailer instead of the zlib ones
+        self.__compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.__compressor.compress(data)
+
+    def flush(self):
+        return self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.__compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(object):
+    content_encoding = "br"
+
+    def __init__(self, level):
+        self.brotli = import_optional("brotli", "response compression")
+        self.level = level
+
+    def compress(self, body):
+        return self.brotli.compress(body, quality=self.level)
+
+    def stream(self):
+        return BrotliStream(self.brotli.Compressor(quality=self.level))
+
+
+class BrotliStream(object):
+    def __init__(self, compressor):
+        self.__compressor = compressor
+
+    def compress(self, data):
+        return self.__compressor.process(data)
+
+    def flush(self):
+        return self.__compressor.flush()
+
+    def finish(self):
+        return self.__compressor.finish()
+
+
+class ZstdCompressor(object):
+    content_encoding = "zstd"
+
+    def __init__(self, level):
+        self.zstandard = import_optional("zstandard", "response compression")
+        self.level = level
+
+    def compress(self, body):
+        return self.zstandard.ZstdCompressor(level=self.level).compress(body)
+
+    def stream(self):
+        return ZstdStream(self.zstandard, self.zstandard.ZstdCompressor(level=self.level).compressobj())
+
+
+class ZstdStream(object):
+    def __init__(self, zstandard, compressor):
+        self.__zstandard = zstandard
+        self.__compressor = compressor
+
+    def compress(self, data):
+        return self.__compressor.compress(data)
+
+    def flush(self):
+        return self.__compressor.flush(self.__zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.__compressor.flush()
+
+
+compressor_classes = {
+    GzipCompressor.content_encoding: GzipCompressor,
+    BrotliCompressor.content_encoding: BrotliCompressor,
+    ZstdCompressor.content_encoding: ZstdCompressor,
+}
+
+
+def get_compressors():
+    """
+    The compressors of COMPRESSION_ENCODINGS, in order of preference.
+    COMPRESSION_LEVEL is capped at 9 for gzip, brotli goes up to 11 and zstd up to 22.
+    """
+    compressors = []
+    for encoding in settings.COMPRESSION_ENCODINGS:
+        if encoding not in compressor_classes:
+            raise Exception("Unknown response compression {}, see documentation for"
+                            " ERROR_CODECS_REQUIREMENTS".format(encoding))
+        level = settings.COMPRESSION_LEVEL
+        if encoding == GzipCompressor.content_encoding:
+            level = min(level, 9)
+        compressors.append(compressor_classes[encoding](level))
+    return compressors
+
+
+def parse_accept_encoding(header):
+    """
+    Maps each coding of an Accept-Encoding header to its quality, codings with q=0 are refused.
+    """
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def negotiate(header, compressors):
+    """
+    The compressor for a request: the one the client prefers by quality, our order breaks ties.
+    """
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for compressor in compressors:
+        quality = accepted.get(compressor.content_encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = compressor, quality
+    return best
+
+
+def is_compressible(content_type):
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return any(content_type.startswith(prefix) for prefix in settings.COMPRESSION_CONTENT_TYPES)
+
+
+class CompressedStream(object):
+    """
+    Passed to the `streaming_fn` of a streamed response instead of the response itself, compresses what it writes.
+    Each write is flushed so that the client receives data as soon as it is produced.
+    """
+
+    def __init__(self, response, stream):
+        self.__response = response
+        self.__stream = stream
+
+    async def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        chunk = self.__stream.compress(data) + self.__stream.flush()
+        if chunk:
+            await self.__response.write(chunk)
+
+    async def finish(self):
+        chunk = self.__stream.finish()
+        if chunk:
+            await self.__response.write(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self.__response, name)
+
+
+def compress_stream(response, compressor):
+    streaming_fn = response.streaming_fn
+
+    async def compressed_streaming_fn(original):
+        stream = CompressedStream(original, compressor.stream())
+        await streaming_fn(stream)
+        await stream.finish()
+
+    response.streaming_fn = compressed_streaming_fn
@@ -23,6 +23,9 @@ class Settings(metaclass=Singleton):
         # Datebase configurations
         self.DB_DEFAULT = config("DB_DEFAULT", cast=str, default=None)
         self.DB_TEST = config("DB_TEST", cast=str, default=None)
+        # psycopg2 executemany mode of the engine: "batch" or "values" send the rows of an executemany (like the
+        # UPDATEs of several related models in one flush) in a few statements, empty keeps one statement per row
+        self.DB_EXECUTEMANY_MODE = config("DB_EXECUTEMANY_MODE", cast=str, default="")
 
         # Database migrations using SQLAlchemy-migrate
         self.DB_MIGRATIONS_FOLDER = config("DB_MIGRATIONS_FOLDER", cast=str, default="db-migrations")
@@ -32,6 +35,16 @@ class Settings(metaclass=Singleton):
             "host": config("DAEMON_HOST", cast=str, default="127.0.0.1"),
             "port": config("DAEMON_PORT", cast=int, default=4000),
         }
+        # Number of pre-forked server processes, `server --workers N` overrides this
+        self.DAEMON_WORKERS = config("DAEMON_WORKERS", cast=int, default=1)
+        # Seconds before a worker that died is replaced, doubled for each other crash within DAEMON_CRASH_WINDOW
+        # seconds, up to DAEMON_RESTART_MAX_DELAY
+        self.DAEMON_RESTART_DELAY = config("DAEMON_RESTART_DELAY", cast=float, default=0.5)
+        self.DAEMON_RESTART_MAX_DELAY = config("DAEMON_RESTART_MAX_DELAY", cast=float, default=30.0)
+        # The server stops and exits with status 1 when workers crash DAEMON_CRASH_LIMIT times within
+        # DAEMON_CRASH_WINDOW seconds, 0 to never stop
+        self.DAEMON_CRASH_LIMIT = config("DAEMON_CRASH_LIMIT", cast=int, default=10)
+        self.DAEMON_CRASH_WINDOW = config("DAEMON_CRASH_WINDOW", cast=float, default=60.0)
 
         self.SERVER_PROTOCOL = config("SERVER_PROTOCOL", cast=str, default="http")
         self.SERVER_DOMAIN = config("SERVER_DOMAIN", cast=str, default="localhost:4000")
@@ -45,21 +58,129 @@ class Settings(metaclass=Singleton):
         self.RABBITMQ_PORT = config("RABBITMQ_PORT", cast=int, default=5672)
         self.RABBITMQ_EXCHANGE = config("RABBITMQ_EXCHANGE", cast=str, default="mq-exchange")
 
+        # JSON library used for responses, request bodies, sessions, the cache and queue messages:
+        # "ujson", "orjson" (needs orjson) or "json". Dates, times, UUIDs, Decimals and Enums are encoded natively
+        self.JSON_BACKEND = config("JSON_BACKEND", cast=str, default="ujson")
+
+        # Queue messages are encoded with this codec, "application/json" or "application/msgpack"
+        self.QUEUE_CONTENT_TYPE = config("QUEUE_CONTENT_TYPE", cast=str, default="application/json")
+        # Compression for queue messages larger than QUEUE_COMPRESSION_THRESHOLD bytes, "zstd", "lz4" or empty for none
+        self.QUEUE_CONTENT_ENCODING = config("QUEUE_CONTENT_ENCODING", cast=str, default="")
+        self.QUEUE_COMPRESSION_THRESHOLD = config("QUEUE_COMPRESSION_THRESHOLD", cast=int, default=1024)
+
+        # Events recorded with backstack.outbox are published by the relay in batches of this size
+        self.OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", cast=int, default=100)
+        # Seconds the relay waits when the outbox is empty
+        self.OUTBOX_POLL_INTERVAL = config("OUTBOX_POLL_INTERVAL", cast=float, default=1.0)
+
         self.MEMCACHED_HOST = config("MEMCACHED_HOST", cast=str, default="localhost")
 
+        # Query result cache, see backstack.cache. Controllers opt in with `cache_timeout` once it is enabled,
+        # without it writes do not bump the table versions in memcached
+        self.CACHE_ENABLED = config("CACHE_ENABLED", cast=bool, default=False)
+        self.CACHE_LOCAL_SIZE = config("CACHE_LOCAL_SIZE", cast=int, default=1000)
+        self.CACHE_DEFAULT_TIMEOUT = config("CACHE_DEFAULT_TIMEOUT", cast=int, default=60)
+        self.CACHE_CONNECT_TIMEOUT = config("CACHE_CONNECT_TIMEOUT", cast=float, default=0.5)
+        # Seconds an expired entry is still served while one request refreshes it
+        self.CACHE_STALE_TIMEOUT = config("CACHE_STALE_TIMEOUT", cast=int, default=30)
+        # The refresh lock expires after CACHE_LOCK_TIMEOUT seconds in case its holder dies,
+        # requests without any cached value wait up to CACHE_LOCK_WAIT seconds for the holder to finish
+        self.CACHE_LOCK_TIMEOUT = config("CACHE_LOCK_TIMEOUT", cast=int, default=10)
+        self.CACHE_LOCK_WAIT = config("CACHE_LOCK_WAIT", cast=float, default=1.0)
+        self.CACHE_LOCK_POLL_INTERVAL = config("CACHE_LOCK_POLL_INTERVAL", cast=float, default=0.05)
+
         self.APPS = ()
 
         self.FILE_UPLOAD_PATH = config("FILE_UPLOAD_PATH", cast=str, default="/tmp/")
         self.S3_BUCKET = config("S3_BUCKET", cast=str, default=None)
         self.S3_ENDPOINT_URL = config("S3_ENDPOINT_URL", cast=str, default=None)
 
+        # Per request timings and the /api/_metrics endpoint (Prometheus text format), which needs METRICS_TOKEN
+        self.METRICS_ENABLED = config("METRICS_ENABLED", cast=bool, default=False)
+        # Send the timings of each request to the client in a Server-Timing header, requires METRICS_ENABLED
+        self.SERVER_TIMING = config("SERVER_TIMING", cast=bool, default=False)
+
+        # Aggregate SQL statements by fingerprint, served at /api/_metrics/sql and shown by the sql_stats command
+        self.SQL_STATS_ENABLED = config("SQL_STATS_ENABLED", cast=bool, default=False)
+        self.SQL_STATS_MAX_STATEMENTS = config("SQL_STATS_MAX_STATEMENTS", cast=int, default=1000)
+        # SELECTs slower than this many milliseconds get their EXPLAIN (ANALYZE, BUFFERS) captured, in a read only
+        # transaction of a connection of its own, at most once per SLOW_QUERY_EXPLAIN_INTERVAL seconds for each
+        # fingerprint, by a background thread
+        self.SLOW_QUERY_THRESHOLD = config("SLOW_QUERY_THRESHOLD", cast=float, default=200.0)
+        self.SLOW_QUERY_EXPLAIN_INTERVAL = config("SLOW_QUERY_EXPLAIN_INTERVAL", cast=int, default=300)
+        # Clients of /api/_metrics and /api/_metrics/sql send "Authorization: Bearer <METRICS_TOKEN>", the routes
+        # are only added with a token
+        self.METRICS_TOKEN = config("METRICS_TOKEN", cast=str, default="")
+
+        # Report statements that repeat NPLUSONE_THRESHOLD times in a request, for development and tests.
+        # "warn" prints them, "raise" also replaces the response with an HTTP 500, empty turns detection off
+        self.NPLUSONE_DETECTION = config("NPLUSONE_DETECTION", cast=str, default="")
+        self.NPLUSONE_THRESHOLD = config("NPLUSONE_THRESHOLD", cast=int, default=3)
+
+        # Load shedding, see backstack.admission. At most ADMISSION_MAX_CONCURRENCY requests are handled at once
+        # (0 for no limit) and ADMISSION_MAX_QUEUED more wait up to ADMISSION_QUEUE_TIMEOUT seconds. Requests beyond
+        # that, or that waited longer for the event loop, get an HTTP 503 with Retry-After: ADMISSION_RETRY_AFTER.
+        # Controllers set their own limit with `max_concurrency`. With a limit, handlers run in a pool of
+        # ADMISSION_MAX_CONCURRENCY threads, keep it at most the size of the DB pool plus its overflow.
+        # ADMISSION_QUEUE_TIMEOUT applies without a limit too, 0 turns it off
+        self.ADMISSION_MAX_CONCURRENCY = config("ADMISSION_MAX_CONCURRENCY", cast=int, default=0)
+        self.ADMISSION_MAX_QUEUED = config("ADMISSION_MAX_QUEUED", cast=int, default=100)
+        self.ADMISSION_QUEUE_TIMEOUT = config("ADMISSION_QUEUE_TIMEOUT", cast=float, default=10.0)
+        self.ADMISSION_RETRY_AFTER = config("ADMISSION_RETRY_AFTER", cast=int, default=1)
+        # Also shed requests while every connection of the DB pool is checked out
+        self.ADMISSION_SHED_ON_POOL_SATURATION = config("ADMISSION_SHED_ON_POOL_SATURATION", cast=bool, default=False)
+
+        # Compression is usually done by the reverse proxy in front of us, turn it on when there is none.
+        # Compress responses of COMPRESSION_MIN_SIZE bytes or more whose content type starts with one of
+        # COMPRESSION_CONTENT_TYPES. COMPRESSION_ENCODINGS in order of preference: "gzip", "br" (needs brotli)
+        # and "zstd" (needs zstandard). Larger bodies than COMPRESSION_EXECUTOR_THRESHOLD are compressed in a thread
+        self.COMPRESSION_ENABLED = config("COMPRESSION_ENABLED", cast=bool, default=False)
+        self.COMPRESSION_ENCODINGS = config(
+            "COMPRESSION_ENCODINGS",
+            cast=lambda v: [s.strip() for s in v.split(",") if s.strip()],
+            default="gzip"
+        )
+        self.COMPRESSION_LEVEL = config("COMPRESSION_LEVEL", cast=int, default=6)
+        self.COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", cast=int, default=1024)
+        self.COMPRESSION_EXECUTOR_THRESHOLD = config("COMPRESSION_EXECUTOR_THRESHOLD", cast=int, default=131072)
+        self.COMPRESSION_CONTENT_TYPES = config(
+            "COMPRESSION_CONTENT_TYPES",
+            cast=lambda v: [s.strip() for s in v.split(",") if s.strip()],
+            default="application/json,text/,application/javascript,application/xml,image/svg+xml"
+        )
+
+        # POST /api/_batch runs up to BATCH_MAX_REQUESTS API calls in one request, see backstack.batch,
+        # with at most BATCH_MAX_CONCURRENCY reads (each using a DB connection) at once
+        self.BATCH_ENABLED = config("BATCH_ENABLED", cast=bool, default=False)
+        self.BATCH_MAX_REQUESTS = config("BATCH_MAX_REQUESTS", cast=int, default=20)
+        self.BATCH_MAX_CONCURRENCY = config("BATCH_MAX_CONCURRENCY", cast=int, default=4)
+
+        # Exports of list controllers (?export=csv) are read by a thread and buffered in up to EXPORT_QUEUE_SIZE
+        # chunks. Without PostgreSQL COPY the thread writes EXPORT_CHUNK_ROWS rows per chunk, see backstack.export
+        self.EXPORT_QUEUE_SIZE = config("EXPORT_QUEUE_SIZE", cast=int, default=16)
+        self.EXPORT_CHUNK_ROWS = config("EXPORT_CHUNK_ROWS", cast=int, default=1000)
+
+        # Each server process opens connections and builds serializers before it accepts connections,
+        # then GETs WARMUP_URLS (comma separated, like /api/things) and only then reports ready at /api/_ready
+        self.WARMUP_ENABLED = config("WARMUP_ENABLED", cast=bool, default=False)
+        self.WARMUP_DB_CONNECTIONS = config("WARMUP_DB_CONNECTIONS", cast=int, default=2)
+        self.WARMUP_URLS = config(
+            "WARMUP_URLS",
+            cast=lambda v: [s.strip() for s in v.split(",") if s.strip()],
+            default=""
+        )
+
         self.SESSION_COOKIE_NAME = config("SESSION_COOKIE_NAME", cast=str, default=None)
 
+        # Origins allowed to make CORS requests: origins, wildcards like https://*.example.com or "*",
+        # and regular expressions prefixed with "re:"
         self.ALLOWED_ORIGINS = config(
             "ALLOWED_ORIGINS",
             cast=lambda v: [s.strip() for s in v.split(',')],
             default="http://localhost:3000,"
         )
+        # Seconds browsers may cache the answer to a CORS preflight
+        self.CORS_MAX_AGE = config("CORS_MAX_AGE", cast=int, default=7200)
 
     def get_mq_exchange_name(self):
         return "{}.{}".format(self.RABBITMQ_EXCHANGE, "topic")
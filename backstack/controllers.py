@@ -1,5 +1,6 @@
 from sanic.views import HTTPMethodView
 
+from .admission import get_controller_limiter, is_limited, run_handler
 from .errors import NotFound
 
 
@@ -7,6 +8,28 @@ class BaseController(HTTPMethodView):
     request = None
     kwargs = None
     __request_initiated = False
+    # Requests to this controller handled at once in each process, None for no limit of its own.
+    # Beyond that `max_queued` requests wait up to `queue_timeout` seconds (defaults from settings), see admission.
+    # With a limit here or in ADMISSION_MAX_CONCURRENCY handlers run in threads, see `admission.run_handler`
+    max_concurrency = None
+    max_queued = None
+    queue_timeout = None
+
+    def dispatch_request(self, request, *args, **kwargs):
+        # The sub-requests of a batch already run in a thread of the batch, on the session of its transaction
+        if not is_limited(self) or getattr(request, "in_batch", False):
+            return super().dispatch_request(request, *args, **kwargs)
+        return self.dispatch_limited(request, *args, **kwargs)
+
+    async def dispatch_limited(self, request, *args, **kwargs):
+        limiter = get_controller_limiter(self) if self.max_concurrency is not None else None
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await run_handler(super().dispatch_request, request, *args, **kwargs)
+        finally:
+            if limiter is not None:
+                limiter.release()
 
     def init_request(self, request, *args, **kwargs):
         self.request = request
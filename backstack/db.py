@@ -1,3 +1,4 @@
+import os
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -19,20 +20,19 @@ class DB(metaclass=Singleton):
     __engine = None
     __session_factory = None
     __scoped_session = None
+    __inherited_engines = []
 
     @property
     def engine(self):
         if self.__engine is None:
             if settings.RUNNING_AS == constants.RUNNING_TEST:
-                self.__engine = create_engine(
-                    settings.DB_TEST,
-                    convert_unicode=True
-                )
+                url = settings.DB_TEST
             else:
-                self.__engine = create_engine(
-                    settings.DB_DEFAULT,
-                    convert_unicode=True
-                )
+                url = settings.DB_DEFAULT
+            kwargs = dict(convert_unicode=True)
+            if settings.DB_EXECUTEMANY_MODE and url.startswith("postgresql"):
+                kwargs["executemany_mode"] = settings.DB_EXECUTEMANY_MODE
+            self.__engine = create_engine(url, **kwargs)
         return self.__engine
 
     @property
@@ -52,6 +52,18 @@ class DB(metaclass=Singleton):
         if self.__scoped_session is not None:
             self.__scoped_session.remove()
 
+    def reset_after_fork(self):
+        """
+        Makes a forked process create its own engine and sessions instead of using the connections of its parent.
+        We keep a reference to the inherited engine: if it was garbage collected its connections would be closed,
+        which also closes them for the parent.
+        """
+        if self.__engine is not None:
+            self.__inherited_engines.append(self.__engine)
+        self.__engine = None
+        self.__session_factory = None
+        self.__scoped_session = None
+
     def test_mode(self):
         settings.RUNNING_AS = constants.RUNNING_TEST
         self.__engine = None
@@ -66,5 +78,6 @@ class DB(metaclass=Singleton):
 
 
 db = DB()
+os.register_at_fork(after_in_child=db.reset_after_fork)
 
 Base = declarative_base()
@@ -2,6 +2,8 @@ from enum import Enum
 import re
 from sanic.exceptions import SanicException
 
+from .config import settings
+
 
 class Errors(Enum):
     REQUIRED_FIELD = "REQUIRED_FIELD"
@@ -22,6 +24,13 @@ class Errors(Enum):
 
     DUPLICATE_UNIQUE_VALUE = "DUPLICATE_UNIQUE_VALUE"
 
+    N_PLUS_ONE_QUERY = "N_PLUS_ONE_QUERY"
+
+    SERVICE_UNAVAILABLE = "SERVICE_UNAVAILABLE"
+
+    PRECONDITION_FAILED = "PRECONDITION_FAILED"
+    EDIT_CONFLICT = "EDIT_CONFLICT"
+
 
 class ModelError(Exception):
     field = None
@@ -67,6 +76,23 @@ class RequiredColumnError(Exception):
         return error
 
 
+class NPlusOneError(Exception):
+    """
+    Used in development and tests when a request runs the same statement for many rows, see backstack.nplusone.
+    """
+    repeated = None
+
+    def __init__(self, repeated):
+        super().__init__(repeated)
+        self.repeated = repeated
+
+    def get_error(self):
+        error = dict()
+        error["__global__"] = Errors.N_PLUS_ONE_QUERY.value
+        error["context"] = self.repeated
+        return error
+
+
 class ServerError(SanicException):
     def __init__(self, message=None, status_code=None):
         super().__init__(
@@ -113,3 +139,52 @@ class Unauthorized(SanicException):
             },
             status_code=status_code if status_code is not None else 403
         )
+
+
+class PreconditionFailed(SanicException):
+    """
+    Used when the If-Match header of an update does not match the current version of the item.
+    """
+    def __init__(self, message=None, status_code=None):
+        super().__init__(
+            message=message if message is not None else {
+                "_server": {
+                    "__global__": Errors.PRECONDITION_FAILED.value,
+                },
+            },
+            status_code=status_code if status_code is not None else 412
+        )
+
+
+class Conflict(SanicException):
+    """
+    Used when an item changed between the moment an update read it and the moment it was written.
+    """
+    def __init__(self, message=None, status_code=None):
+        super().__init__(
+            message=message if message is not None else {
+                "_server": {
+                    "__global__": Errors.EDIT_CONFLICT.value,
+                },
+            },
+            status_code=status_code if status_code is not None else 409
+        )
+
+
+class ServiceUnavailable(SanicException):
+    """
+    Used when a request is shed because the server is overloaded, see backstack.admission.
+    Clients are told to retry after `retry_after` seconds with the Retry-After header.
+    """
+    retry_after = None
+
+    def __init__(self, message=None, status_code=None, retry_after=None):
+        super().__init__(
+            message=message if message is not None else {
+                "_server": {
+                    "__global__": Errors.SERVICE_UNAVAILABLE.value,
+                },
+            },
+            status_code=status_code if status_code is not None else 503
+        )
+        self.retry_after = retry_after if retry_after is not None else settings.ADMISSION_RETRY_AFTER
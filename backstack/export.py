@@ -0,0 +1,132 @@
+import asyncio
+import csv
+import io
+import threading
+from sanic import response
+
+from .config import settings
+from .db import db
+
+
+class ExportCancelled(Exception):
+    """
+    Raised in the thread of an export when its response stopped, to end the query.
+    """
+
+
+class CopyWriter(object):
+    """
+    The file that `copy_expert` writes the output of COPY to.
+    """
+
+    def __init__(self, write):
+        self.write = write
+
+
+def copy_csv(statement, write):
+    """
+    Runs `COPY (<statement>) TO STDOUT` on PostgreSQL, which sends CSV with a header row made of the column labels.
+    """
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        compiled = statement.compile(dialect=db.engine.dialect)
+        sql = cursor.mogrify(str(compiled), compiled.params).decode("utf-8")
+        cursor.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(sql), CopyWriter(write))
+    except ExportCancelled:
+        # The COPY was interrupted, do not give this connection back to the pool
+        connection.invalidate()
+        raise
+    finally:
+        connection.close()
+
+
+def fetch_csv(statement, write):
+    """
+    Writes CSV from the rows of a statement, EXPORT_CHUNK_ROWS at a time, for databases without COPY.
+    """
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(result.keys())
+        while True:
+            rows = result.fetchmany(settings.EXPORT_CHUNK_ROWS)
+            if rows:
+                writer.writerows(rows)
+            if buffer.tell():
+                write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+            if not rows:
+                break
+
+
+def write_csv(statement, write):
+    if db.engine.dialect.name == "postgresql":
+        copy_csv(statement, write)
+    else:
+        fetch_csv(statement, write)
+
+
+async def stream_from_thread(resp, produce):
+    """
+    Runs `produce(write)` in a thread of its own and writes what it produces to a streamed response.
+    At most EXPORT_QUEUE_SIZE chunks wait in between, a slow client makes the thread wait instead of buffering
+    the whole result.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=settings.EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def write(data):
+        if cancelled.is_set():
+            raise ExportCancelled()
+        asyncio.run_coroutine_threadsafe(queue.put(data), loop).result()
+
+    def run():
+        end = None
+        try:
+            produce(write)
+        except Exception as e:
+            end = e
+        asyncio.run_coroutine_threadsafe(queue.put(end), loop).result()
+
+    threading.Thread(target=run, daemon=True).start()
+    finished = False
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                finished = True
+                if chunk is not None:
+                    raise chunk
+                return
+            await resp.write(chunk)
+    finally:
+        if not finished:
+            # Writing failed: let the thread finish its current write, see that it is cancelled and end
+            cancelled.set()
+            while True:
+                chunk = await queue.get()
+                if chunk is None or isinstance(chunk, Exception):
+                    break
+
+
+def csv_response(statement, filename):
+    """
+    A chunked response with the result of a statement as CSV, see `ListMixin.handle_export`.
+    """
+    async def streaming_fn(resp):
+        try:
+            await stream_from_thread(resp, lambda write: write_csv(statement, write))
+        except Exception as e:
+            # The status and headers are already sent, the client sees a truncated body
+            print("Export of {} failed:".format(filename), e)
+            raise
+
+    return response.stream(
+        streaming_fn,
+        content_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="{}"'.format(filename)},
+    )
@@ -0,0 +1,129 @@
+import hashlib
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from sanic import response
+
+
+def make_etag(value, variant=None):
+    """
+    Creates a strong ETag from a value that changes whenever the resource changes (a row version, a timestamp, ...).
+    The `variant` is used for things that change the representation but not the data, like the query string.
+    """
+    tag = hashlib.md5(str(value).encode("utf-8")).hexdigest()
+    if variant:
+        tag = "{}-{}".format(tag, hashlib.md5(str(variant).encode("utf-8")).hexdigest()[:8])
+    return '"{}"'.format(tag)
+
+
+def make_body_etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+def parse_etags(header):
+    """
+    Splits an If-None-Match or If-Match header into opaque tags, weak tags are returned without their W/ prefix.
+    """
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    tags = parse_etags(header)
+    return "*" in tags or etag in tags
+
+
+def strip_variant(tag):
+    """
+    The ETag of `make_etag` without its variant suffix.
+    """
+    if tag.startswith('"') and "-" in tag:
+        return tag.split("-")[0] + '"'
+    return tag
+
+
+def if_match(request, etag=None):
+    """
+    Evaluates If-Match, True when there is none. Tags are compared without their variant, since any representation
+    of the current version of a resource may be updated, and weak tags match like strong ones.
+    """
+    header = request.headers.get("If-Match", None)
+    if header is None:
+        return True
+    tags = [strip_variant(tag) for tag in parse_etags(header)]
+    if "*" in tags:
+        return True
+    if etag is None:
+        return False
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return strip_variant(etag) in tags
+
+
+def if_match_hashes(request):
+    """
+    The hashes of the If-Match tags, to compare with `md5(version)` in SQL. None when any version matches.
+    """
+    header = request.headers.get("If-Match", None)
+    if header is None:
+        return None
+    tags = [strip_variant(tag) for tag in parse_etags(header)]
+    if "*" in tags:
+        return None
+    return [tag.strip('"') for tag in tags]
+
+
+def format_http_date(value):
+    if value.tzinfo is None:
+        # We store timestamps in UTC without a time zone
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def modified_since(header, last_modified):
+    if not header:
+        return True
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return True
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # HTTP dates have a resolution of seconds
+    return last_modified.replace(microsecond=0) > since
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Evaluates If-None-Match and If-Modified-Since as described in RFC 7232, If-None-Match takes precedence.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if_none_match = request.headers.get("If-None-Match", None)
+    if if_none_match is not None:
+        return etag is not None and etag_matches(if_none_match, etag)
+    if last_modified is not None:
+        return not modified_since(request.headers.get("If-Modified-Since", None), last_modified)
+    return False
+
+
+def not_modified(etag=None, last_modified=None):
+    return response.raw(b"", status=304, headers=validator_headers(etag, last_modified))
+
+
+def validator_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = format_http_date(last_modified)
+    return headers
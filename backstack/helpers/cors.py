@@ -1,17 +1,70 @@
+import re
 from sanic import response
 
 from ..config import settings
 
 
+class OriginMatcher(object):
+    """
+    Tells if an origin is allowed by ALLOWED_ORIGINS, whose entries are either:
+      - an origin, like "https://app.example.com", looked up in a set,
+      - a wildcard, like "https://*.example.com", where "*" stands for one label of the host name, so it does not
+        match "https://evil.com/.example.com" or "https://a.b.example.com", or "*" alone for any origin,
+      - a regular expression prefixed with "re:", like "re:https://pr-\\d+\\.example\\.com".
+    Wildcards and regular expressions are compiled once into a single pattern.
+    """
+
+    def __init__(self, allowed_origins):
+        self.allowed_origins = allowed_origins
+        self.exact = set()
+        self.allow_all = False
+        patterns = []
+        for origin in allowed_origins:
+            if not origin:
+                continue
+            if origin == "*":
+                self.allow_all = True
+            elif origin.startswith("re:"):
+                patterns.append(origin[3:])
+            elif "*" in origin:
+                patterns.append("[^/.:]+".join(re.escape(part) for part in origin.split("*")))
+            else:
+                self.exact.add(origin)
+        self.pattern = re.compile("|".join("(?:%s)" % p for p in patterns)) if patterns else None
+
+    def matches(self, origin):
+        if not origin:
+            return False
+        if self.allow_all or origin in self.exact:
+            return True
+        return self.pattern is not None and self.pattern.fullmatch(origin) is not None
+
+
+origin_matcher = None
+
+
+def is_allowed_origin(origin):
+    global origin_matcher
+    # Rebuilt only when the setting is replaced, for example by the `override_settings` of create_app
+    if origin_matcher is None or origin_matcher.allowed_origins is not settings.ALLOWED_ORIGINS:
+        origin_matcher = OriginMatcher(settings.ALLOWED_ORIGINS)
+    return origin_matcher.matches(origin)
+
+
+def get_preflight_headers(allowed_methods, allowed_headers):
+    return {
+        "Access-Control-Allow-Methods": allowed_methods,
+        "Access-Control-Allow-Headers": allowed_headers,
+        "Access-Control-Max-Age": str(settings.CORS_MAX_AGE),
+        "Vary": "Origin",
+    }
+
+
 def handle_cors(request, allowed_methods, allowed_headers):
     if "ORIGIN" in request.headers:
         origin = request.headers["ORIGIN"]
-        if origin in settings.ALLOWED_ORIGINS:
-            headers = {
-                "Access-Control-Allow-Methods": allowed_methods,
-                "Access-Control-Allow-Headers": allowed_headers,
-            }
-            return response.raw("", status=204, headers=headers)
+        if is_allowed_origin(origin):
+            return response.raw("", status=204, headers=get_preflight_headers(allowed_methods, allowed_headers))
         else:
             return response.raw("", status=204)
     else:
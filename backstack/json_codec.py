@@ -0,0 +1,118 @@
+import datetime
+import decimal
+import enum
+import importlib
+import uuid
+from sanic import response
+
+from .config import settings
+
+
+def default(value):
+    """
+    Encodes the types that JSON does not have: dates and times as ISO 8601, UUIDs as strings, Decimals as strings,
+    which keep all their digits, and Enums as their value.
+    ujson never calls this for Decimals, it encodes them as floats: serializers dump Decimal fields as strings.
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(value.__class__.__name__))
+
+
+class OrjsonBackend(object):
+    name = "orjson"
+
+    def __init__(self):
+        try:
+            self.orjson = importlib.import_module("orjson")
+        except ImportError:
+            raise Exception("You have to install orjson to use it as JSON_BACKEND,"
+                            " see documentation for ERROR_CODECS_REQUIREMENTS")
+        # ujson and json turn keys like integers into strings, orjson only does with this option
+        self.option = self.orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(self, data):
+        return self.orjson.dumps(data, default=default, option=self.option)
+
+    def dumps(self, data):
+        return self.dumps_bytes(data).decode("utf-8")
+
+    def loads(self, payload):
+        return self.orjson.loads(payload)
+
+
+class UjsonBackend(object):
+    name = "ujson"
+
+    def __init__(self):
+        self.ujson = importlib.import_module("ujson")
+
+    def dumps(self, data):
+        return self.ujson.dumps(data, default=default, ensure_ascii=False, escape_forward_slashes=False)
+
+    def dumps_bytes(self, data):
+        return self.dumps(data).encode("utf-8")
+
+    def loads(self, payload):
+        return self.ujson.loads(payload)
+
+
+class StdlibBackend(object):
+    name = "json"
+
+    def __init__(self):
+        self.json = importlib.import_module("json")
+
+    def dumps(self, data):
+        return self.json.dumps(data, default=default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_bytes(self, data):
+        return self.dumps(data).encode("utf-8")
+
+    def loads(self, payload):
+        return self.json.loads(payload)
+
+
+backends = {
+    OrjsonBackend.name: OrjsonBackend,
+    UjsonBackend.name: UjsonBackend,
+    StdlibBackend.name: StdlibBackend,
+}
+backend = None
+
+
+def get_backend():
+    global backend
+    if backend is None or backend.name != settings.JSON_BACKEND:
+        if settings.JSON_BACKEND not in backends:
+            raise Exception("Unknown JSON_BACKEND {}, see documentation for"
+                            " ERROR_CODECS_REQUIREMENTS".format(settings.JSON_BACKEND))
+        backend = backends[settings.JSON_BACKEND]()
+    return backend
+
+
+def dumps(data):
+    return get_backend().dumps(data)
+
+
+def dumps_bytes(data):
+    return get_backend().dumps_bytes(data)
+
+
+def loads(payload):
+    return get_backend().loads(payload)
+
+
+def json_response(body, status=200, headers=None, content_type="application/json"):
+    """
+    Like `sanic.response.json` but encoded with JSON_BACKEND.
+    """
+    return response.HTTPResponse(dumps_bytes(body), status=status, headers=headers, content_type=content_type)
@@ -0,0 +1,206 @@
+import hmac
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from inspect import isawaitable, iscoroutinefunction
+from sanic import response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+from .errors import Unauthenticated
+
+
+# Timings of the request that is being handled in the current asyncio task, None outside of requests
+current_timings = ContextVar("current_timings", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimings(object):
+    def __init__(self, request=None):
+        self.request = request
+        self.start = time.perf_counter()
+        self.spans = []
+        self.query_count = 0
+        self.query_time = 0.0
+
+    def add_span(self, name, duration):
+        self.spans.append((name, duration))
+
+    def add_query(self, duration):
+        self.query_count += 1
+        self.query_time += duration
+
+    @property
+    def route(self):
+        # Sanic sets the matched URI template after the request middlewares, until then we have no route
+        return getattr(self.request, "uri_template", None)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        parts = ["{};dur={:.2f}".format(name, duration * 1000) for (name, duration) in self.spans]
+        parts.append('db;dur={:.2f};desc="{} queries"'.format(self.query_time * 1000, self.query_count))
+        parts.append("total;dur={:.2f}".format(self.elapsed * 1000))
+        return ", ".join(parts)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One counter per bucket plus one for +Inf, these are not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.query_count = 0
+        self.query_time = 0.0
+
+
+routes = {}
+
+
+@contextmanager
+def timed(name):
+    """
+    Records the time spent in the block as a span of the current request, does nothing outside of requests.
+    """
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_span(name, time.perf_counter() - start)
+
+
+def timed_middleware(middleware):
+    """
+    Wraps a request or response middleware so that it is recorded as a span, named after the function.
+    """
+    name = middleware.__qualname__.replace(".<locals>", "")
+
+    if iscoroutinefunction(middleware):
+        @wraps(middleware)
+        async def inner(*args):
+            with timed(name):
+                return await middleware(*args)
+    else:
+        @wraps(middleware)
+        def inner(*args):
+            with timed(name):
+                result = middleware(*args)
+            if isawaitable(result):
+                return timed_awaitable(name, result)
+            return result
+    return inner
+
+
+async def timed_awaitable(name, awaitable):
+    with timed(name):
+        return await awaitable
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add_query(duration)
+
+
+def handle_error(context):
+    # after_cursor_execute is not called for a statement that failed
+    starts = context.connection.info.get("query_start", None) if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def setup_query_events():
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+
+def record_request(method, route, timings):
+    key = (method, route)
+    if key not in routes:
+        routes[key] = RouteMetrics()
+    metrics = routes[key]
+    metrics.latency.observe(timings.elapsed)
+    metrics.query_count += timings.query_count
+    metrics.query_time += timings.query_time
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_prometheus():
+    """
+    Per route metrics of this process in the Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP backstack_request_duration_seconds Request latency by route",
+        "# TYPE backstack_request_duration_seconds histogram",
+    ]
+    for (method, route), metrics in sorted(routes.items()):
+        labels = 'method="{}",route="{}"'.format(escape_label(method), escape_label(route))
+        cumulative = 0
+        for bucket, count in zip(metrics.latency.buckets + ("+Inf", ), metrics.latency.counts):
+            cumulative += count
+            lines.append('backstack_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bucket, cumulative))
+        lines.append("backstack_request_duration_seconds_sum{{{}}} {}".format(labels, metrics.latency.sum))
+        lines.append("backstack_request_duration_seconds_count{{{}}} {}".format(labels, metrics.latency.count))
+
+    lines.append("# HELP backstack_db_queries_total Database queries by route")
+    lines.append("# TYPE backstack_db_queries_total counter")
+    for (method, route), metrics in sorted(routes.items()):
+        labels = 'method="{}",route="{}"'.format(escape_label(method), escape_label(route))
+        lines.append("backstack_db_queries_total{{{}}} {}".format(labels, metrics.query_count))
+
+    lines.append("# HELP backstack_db_query_seconds_total Time spent in database queries by route")
+    lines.append("# TYPE backstack_db_query_seconds_total counter")
+    for (method, route), metrics in sorted(routes.items()):
+        labels = 'method="{}",route="{}"'.format(escape_label(method), escape_label(route))
+        lines.append("backstack_db_query_seconds_total{{{}}} {}".format(labels, metrics.query_time))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_token_required(view):
+    """
+    Only lets requests with the header "Authorization: Bearer <METRICS_TOKEN>" in, see `create_app`.
+    """
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if not settings.METRICS_TOKEN or scheme.lower() != "bearer" or \
+                not hmac.compare_digest(token.encode("utf-8"), settings.METRICS_TOKEN.encode("utf-8")):
+            raise Unauthenticated()
+        return view(request, *args, **kwargs)
+    return inner
+
+
+@metrics_token_required
+def metrics_view(request):
+    return response.text(render_prometheus(), content_type="text/plain; version=0.0.4")
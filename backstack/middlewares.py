@@ -1,35 +1,220 @@
+import asyncio
+from sanic.exceptions import SanicException
+from sanic.response import raw, StreamingHTTPResponse
+
 from .config import settings
 from .auth import auth
+from .db import db
+from .errors import NPlusOneError
+from .json_codec import dumps_bytes
+from .helpers.cors import is_allowed_origin, get_preflight_headers
 from .session import MemcacheSession
+from .metrics import timed
+
+
+def add_vary(response, header):
+    vary = response.headers.get("Vary", "")
+    if header.lower() not in [v.strip().lower() for v in vary.split(",")]:
+        response.headers["Vary"] = "{}, {}".format(vary, header) if vary else header
+
+
+def metrics_middlewares(app):
+    """
+    Measures every request: spans for middlewares and mixin stages, DB query count and time.
+    This has to be the first of the middlewares so that its response middleware runs after all the others.
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    from .metrics import RequestTimings, current_timings, record_request, setup_query_events
+    setup_query_events()
+
+    def request_middleware(request):
+        current_timings.set(RequestTimings(request))
+
+    def response_middleware(request, response):
+        timings = current_timings.get()
+        if timings is None:
+            return
+        # Unmatched URLs share one label so that random paths do not create new series
+        record_request(request.method, timings.route or "unmatched", timings)
+        if settings.SERVER_TIMING:
+            response.headers["Server-Timing"] = timings.server_timing()
+
+    request_middleware.untimed = True
+    response_middleware.untimed = True
+    app.register_middleware(request_middleware, attach_to="request")
+    app.register_middleware(response_middleware, attach_to="response")
+
+
+def admission_middlewares(app):
+    """
+    Responds to requests that admission control rejected, see `MainApp.handle_request`.
+    Raising here skips the handler and the other request middlewares but not the response middlewares.
+    """
+    def request_middleware(request):
+        error = getattr(request, "admission_error", None)
+        if error is not None:
+            raise error
+
+    app.register_middleware(request_middleware, attach_to="request")
+
+
+def compression_middlewares(app):
+    """
+    Compresses responses with the best of COMPRESSION_ENCODINGS that the client accepts, see backstack.compression.
+    Bodies of COMPRESSION_EXECUTOR_THRESHOLD bytes or more are compressed in a thread, off the event loop.
+    """
+    if not settings.COMPRESSION_ENABLED:
+        return
+    from .compression import get_compressors, negotiate, is_compressible, compress_stream
+    compressors = get_compressors()
+
+    def weaken_etag(response):
+        # A compressed body is not byte for byte the same representation, so the validator can only be weak
+        etag = response.headers.get("ETag", None)
+        if etag and not etag.startswith("W/"):
+            response.headers["ETag"] = "W/" + etag
+
+    async def response_middleware(request, response):
+        if response.status == 304:
+            # It stands for the response that would have been compressed, its headers must be the same
+            add_vary(response, "Accept-Encoding")
+            if negotiate(request.headers.get("Accept-Encoding", None), compressors) is not None:
+                weaken_etag(response)
+            return
+        if (response.status < 200 or response.status == 204 or "Content-Encoding" in response.headers or
+                not is_compressible(response.content_type)):
+            return
+        add_vary(response, "Accept-Encoding")
+
+        compressor = negotiate(request.headers.get("Accept-Encoding", None), compressors)
+        if compressor is None:
+            return
+        # Also when the body is too small to be compressed, the 304s cannot tell
+        weaken_etag(response)
+        if isinstance(response, StreamingHTTPResponse):
+            compress_stream(response, compressor)
+        else:
+            if len(response.body) < settings.COMPRESSION_MIN_SIZE:
+                return
+            if len(response.body) >= settings.COMPRESSION_EXECUTOR_THRESHOLD:
+                body = await asyncio.get_event_loop().run_in_executor(None, compressor.compress, response.body)
+            else:
+                body = compressor.compress(response.body)
+            response.body = body
+            response.headers.pop("Content-Length", None)
+        response.headers["Content-Encoding"] = compressor.content_encoding
+
+    app.register_middleware(response_middleware, attach_to="response")
+
+
+def nplusone_middlewares(app):
+    """
+    Development and test helper that reports statements repeated within one request, see backstack.nplusone.
+    With NPLUSONE_DETECTION = "raise" the response is turned into an HTTP 500 so that tests fail. It is changed in
+    place, a returned response would skip the response middlewares after this one (compression, metrics).
+    """
+    if settings.NPLUSONE_DETECTION not in ("warn", "raise"):
+        return
+    from . import nplusone
+    nplusone.setup_detection()
+
+    def request_middleware(request):
+        nplusone.current_log.set(nplusone.QueryLog())
+
+    def response_middleware(request, response):
+        log = nplusone.current_log.get()
+        if log is None:
+            return
+        repeated = log.get_repeated()
+        if repeated:
+            print("In {} {}:".format(request.method, request.path))
+            print(nplusone.describe(repeated))
+            if settings.NPLUSONE_DETECTION == "raise":
+                body = dumps_bytes(NPlusOneError(repeated).get_error())
+                response.status = 500
+                response.content_type = "application/json"
+                if isinstance(response, StreamingHTTPResponse):
+                    async def streaming_fn(resp):
+                        await resp.write(body)
+                    response.streaming_fn = streaming_fn
+                else:
+                    response.body = body
+                    response.headers.pop("Content-Length", None)
+                # The validators were those of the original body
+                response.headers.pop("ETag", None)
+                response.headers.pop("Last-Modified", None)
+
+    app.register_middleware(request_middleware, attach_to="request")
+    app.register_middleware(response_middleware, attach_to="response")
 
 
 def session_middlewares(app):
     session_store = MemcacheSession()
 
     def request_middleware(request):
-        session_store.set_session_key(request=request)
-        request.session = session_store
-        user = auth.current_user(request)
+        with timed("session_load"):
+            # A session of its own for this request, the store is shared by all the requests of the process
+            request.session = session_store.load_request_session(request)
+        with timed("current_user"):
+            user = auth.current_user(request)
         if user:
             request.user = user
         else:
             request.user = None
 
-    def response_middleware(_, response):
-        if session_store.is_dirty:
-            session_store.save()
-            response.cookies[settings.SESSION_COOKIE_NAME] = session_store.get_session_key()
+    def response_middleware(request, response):
+        # The user was loaded with the DB session of the event loop thread, end its transaction and give its
+        # connection back to the pool so that it is not kept idle in a transaction nor serves stale rows later
+        db.remove_session()
+        # The session was not loaded for requests answered by an earlier request middleware, like CORS preflights
+        session = getattr(request, "session", None)
+        if session is None:
+            return
+        if session.is_dirty:
+            session.save()
+            response.cookies[settings.SESSION_COOKIE_NAME] = session.get_session_key()
             response.cookies[settings.SESSION_COOKIE_NAME]["max-age"] = 3600*24*60
-        return response
+        # We change the response in place, returning it would stop Sanic from running the other response middlewares
 
     app.register_middleware(request_middleware, attach_to="request")
     app.register_middleware(response_middleware, attach_to="response")
 
 
 def cors_middlewares(app):
+    """
+    Answers CORS preflights of controllers with CORSMixin before any other request middleware (which is why this
+    comes before `session_middlewares`), with headers computed once per controller. Browsers cache them for
+    CORS_MAX_AGE seconds.
+    """
+    preflight_headers = {}
+
+    def get_controller(request):
+        try:
+            handler = app.router.get(request)[0]
+        except SanicException:
+            return None
+        controller = getattr(handler, "view_class", None)
+        if controller is None or not hasattr(controller, "allowed_methods"):
+            return None
+        return controller
+
+    def request_middleware(request):
+        if (request.method != "OPTIONS" or "Access-Control-Request-Method" not in request.headers or
+                not is_allowed_origin(request.headers.get("ORIGIN", None))):
+            return
+        controller = get_controller(request)
+        if controller is None:
+            return
+        if controller not in preflight_headers:
+            preflight_headers[controller] = get_preflight_headers(controller.allowed_methods, controller.allowed_headers)
+        return raw("", status=204, headers=preflight_headers[controller])
+
     def response_middleware(request, response):
         origin = request.headers.get("ORIGIN", None)
-        if origin and origin in settings.ALLOWED_ORIGINS:
+        if is_allowed_origin(origin):
             response.headers["Access-Control-Allow-Origin"] = origin
+            add_vary(response, "Origin")
 
+    app.register_middleware(request_middleware, attach_to="request")
     app.register_middleware(response_middleware, attach_to="response")
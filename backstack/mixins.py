@@ -1,12 +1,45 @@
-from sanic import response
+from datetime import datetime
 from psycopg2 import DataError
+from sanic.response import raw
+from sqlalchemy import Boolean, DateTime, Integer, Text, and_, cast, delete, func, insert, inspect, update
 from sqlalchemy.exc import IntegrityError, StatementError, DataError, ProgrammingError
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import joinedload, load_only, make_transient_to_detached, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+from sqlalchemy.sql.util import find_tables
 from marshmallow.exceptions import ValidationError
 
+from .config import settings
 from .db import db
-from .errors import NotFound, ServerError, Errors, UniqueConstraintError
+from .errors import Conflict, ModelError, NotFound, PreconditionFailed, ServerError, Errors, UniqueConstraintError
 from .helpers.cors import handle_cors
+from .helpers.conditional import make_etag, make_body_etag, is_not_modified, not_modified, validator_headers, \
+    if_match, if_match_hashes
+from .json_codec import json_response
+from .metrics import timed
+from .models import integrity_error
+from .schema import fields
+from . import registry, upsert
+
+
+def bump_tables(*tables):
+    if not settings.CACHE_ENABLED:
+        return
+    # backstack.cache is imported by the first write or cached read, not with the mixins
+    from .cache import cache
+    cache.bump_version(*tables)
+
+
+def enqueue_events(events):
+    """
+    Writes (routing key, data) events to the outbox in the current transaction. The outbox, and the message queue
+    client that it imports, are only loaded by apps that publish events.
+    """
+    if not events:
+        return
+    from . import outbox
+    for key, data in events:
+        outbox.enqueue(key, data)
 
 
 class QueryFilter(object):
@@ -72,10 +105,82 @@ class QueryFilter(object):
         return filters
 
 
+def get_eager_load_options(model, schema, parent=None, depth=3):
+    """
+    Creates loader options for the relationships that a serializer renders with Nested fields (only the fields left
+    after `only`/`exclude`), recursively. Collections are loaded with selectinload, everything else with joinedload.
+    """
+    options = []
+    if depth == 0:
+        return options
+    relationships = inspect(model).relationships
+    for name, field in schema.fields.items():
+        if not isinstance(field, fields.Nested) or field.load_only:
+            continue
+        attribute = field.attribute or name
+        if attribute not in relationships:
+            continue
+        relationship = relationships[attribute]
+        loader = selectinload if relationship.uselist else joinedload
+        if parent is None:
+            option = loader(getattr(model, attribute))
+        else:
+            # Chain onto the option of the parent relationship, e.g. joinedload(A.b).selectinload(B.c)
+            option = getattr(parent, loader.__name__)(getattr(model, attribute))
+        options.append(option)
+        options.extend(get_eager_load_options(relationship.mapper.class_, field.schema, option, depth - 1))
+    return options
+
+
+def get_sparse_only(serializer_class, sparse, depth=3):
+    """
+    Turns sparse fieldsets ({resource: "a,b"}) into a marshmallow `only` list for a serializer.
+    A resource is the table name of a serializer's `Meta.model`, fields of nested serializers get dotted names.
+    :return: The list of field names or None when no field of this serializer is left out
+    """
+    meta = getattr(serializer_class, "Meta", None)
+    resource = meta.model.__table__.name if hasattr(meta, "model") else None
+    declared = serializer_class._declared_fields
+    restricted = resource in sparse
+    if restricted:
+        names = [n.strip() for n in sparse[resource].split(",") if n.strip()]
+        if [n for n in names if n not in declared]:
+            raise ServerError({
+                "_schema": {
+                    "fields": [Errors.INVALID_INPUT.value],
+                },
+            }, status_code=400)
+        if "id" in declared and "id" not in names:
+            names.insert(0, "id")
+    else:
+        names = list(declared.keys())
+
+    only = []
+    for name in names:
+        nested = getattr(declared[name], "nested", None)
+        if isinstance(declared[name], fields.Nested) and isinstance(nested, type) and depth > 1:
+            nested_only = get_sparse_only(nested, sparse, depth - 1)
+            if nested_only is not None:
+                restricted = True
+                only.extend("{}.{}".format(name, n) for n in nested_only)
+                continue
+        only.append(name)
+    return only if restricted else None
+
+
 class ModelMixin(object):
+    """
+    `auto_eager_load` derives loader options from the serializer, so that relationships rendered by Nested fields
+    are not lazy loaded one row at a time. Set `loader_options` to a list of options to use those instead.
+    Neither is done for a custom `query` or a grouped one, which may not select instances of the model.
+    """
     model = None
     serializer_class = None
     query = None
+    auto_eager_load = True
+    loader_options = None
+    __sparse_only = None
+    __sparse_parsed = False
 
     def get_model(self):
         return self.model
@@ -97,24 +202,326 @@ class ModelMixin(object):
 
         return query
 
+    def has_custom_query(self):
+        return self.query is not None or hasattr(self, "get_grouping")
+
+    def get_loader_options(self):
+        if self.loader_options is not None:
+            return list(self.loader_options)
+        if not self.auto_eager_load or self.serializer_class is None or self.has_custom_query():
+            return []
+        return get_eager_load_options(self.get_model(), self.get_serializer())
+
+    def get_loaded_queryset(self):
+        """
+        The queryset with loader options, for queries that load instances (not for counts or aggregates).
+        """
+        options = self.get_loader_options()
+        columns = None if self.has_custom_query() else self.get_sparse_columns()
+        if columns:
+            options.append(load_only(*columns))
+        return self.get_queryset().options(*options)
+
+    def get_sparse_fields(self):
+        """
+        Sparse fieldsets from the query string of GET requests, JSON:API style like our `page[number]`:
+        `fields[<table name>]=a,b` for the resource or for nested resources, `fields=a,b` for the resource itself.
+        """
+        sparse = {}
+        if self.request is None or self.request.method not in ("GET", "HEAD"):
+            return sparse
+        for key in self.request.args.keys():
+            if key == "fields":
+                sparse[self.get_model().__table__.name] = self.request.args.get(key)
+            elif key.startswith("fields[") and key.endswith("]"):
+                sparse[key[7:-1]] = self.request.args.get(key)
+        return sparse
+
+    def get_sparse_only(self):
+        # Parsed once per request, both the serializer and the loaded queryset use it
+        if not self.__sparse_parsed:
+            sparse = self.get_sparse_fields()
+            if sparse and self.serializer_class is not None:
+                self.__sparse_only = get_sparse_only(self.serializer_class, sparse)
+            self.__sparse_parsed = True
+        return self.__sparse_only
+
+    def get_sparse_columns(self):
+        """
+        The columns to load when sparse fieldsets are requested: the ones the requested fields render,
+        primary and foreign keys (needed to load relationships) and the ETag column.
+        None, so every column is loaded, when a requested field is not a column or a Nested relationship: Method,
+        Function and property fields may read any attribute and would lazy load it one row at a time.
+        """
+        only = self.get_sparse_only()
+        if only is None:
+            return None
+        model = self.get_model()
+        info = self.get_model_info()
+        declared = self.serializer_class._declared_fields
+        keys = set()
+        for name in set(n.split(".")[0] for n in only):
+            attribute = declared[name].attribute or name
+            if attribute in info.column_attributes:
+                keys.add(attribute)
+            elif not (isinstance(declared[name], fields.Nested) and attribute in info.relationships):
+                return None
+        for c in info.columns:
+            if c.primary_key or c.foreign_keys:
+                keys.add(info.attribute_names[c])
+        if hasattr(self, "get_etag_column") and self.get_etag_column() is not None:
+            keys.add(self.get_etag_column().key)
+        return [getattr(model, k) for k in sorted(keys)]
+
+    def get_model_info(self):
+        return registry.get_model_info(self.get_model())
+
     def has_related(self):
-        m = self.get_model()
-        fks = [c for c in m.__table__.columns.values() if c.foreign_keys]
-        return True if len(fks) else False
+        return True if len(self.get_model_info().foreign_keys) else False
+
+    def save_related(self, related_fields):
+        """
+        Saves the related models of `related_fields` that are set on the instance, new ones are inserted and existing
+        ones updated. They are flushed together, with their own related models, in one unit of work which orders the
+        statements by dependency, then their keys are copied to the foreign key columns of the instance.
 
-    def get_serializer(self, instance=None):
+        Foreign key names are assumed to be ending in "_id" or "_fk"
+        """
+        saved = []
+        for column_name, name, referenced in self.get_model_info().foreign_keys:
+            if name is None or name not in related_fields:
+                continue
+            fk_instance = getattr(self.instance, name, None)
+            if not fk_instance:
+                continue
+            if hasattr(fk_instance, "created_from"):
+                fk_instance.created_from = self.request.client_ip
+            db.session.add(fk_instance)
+            saved.append((column_name, fk_instance, referenced))
+        if not saved:
+            return
+
+        try:
+            db.session.flush()
+        except IntegrityError as err:
+            db.session.rollback()
+            raise integrity_error(err)
+        for column_name, fk_instance, referenced in saved:
+            setattr(self.instance, column_name, getattr(fk_instance, referenced.name))
+
+    def get_written_tables(self, related_fields=None):
+        """
+        Names of the tables that a create or update writes to, cached results that read them are invalidated on commit.
+        """
+        info = self.get_model_info()
+        tables = [info.table_name]
+        for column_name, name, referenced in info.foreign_keys:
+            if related_fields and column_name[:-3] in related_fields:
+                tables.append(referenced.table.name)
+        return tables
+
+    def get_serializer(self, instance=None, raw=False):
         partial = True if self.request.method == "PATCH" else False
+        kwargs = dict(partial=partial)
         if instance:
-            return self.serializer_class(partial=partial, instance=instance)
-        else:
-            return self.serializer_class(partial=partial)
+            kwargs["instance"] = instance
+        if raw:
+            kwargs["raw"] = True
+        only = self.get_sparse_only()
+        if only is not None:
+            kwargs["only"] = only
+        return self.serializer_class(**kwargs)
+
+
+nested_tables = {}
 
 
-class ListMixin(QueryFilter, ModelMixin):
+def get_nested_tables(serializer_class):
+    """
+    Names of the tables of all models rendered by a serializer, following Nested fields.
+    """
+    if serializer_class not in nested_tables:
+        nested_tables[serializer_class] = set()
+        tables = set()
+        meta = getattr(serializer_class, "Meta", None)
+        if hasattr(meta, "model"):
+            tables.add(meta.model.__table__.name)
+        for field in serializer_class().fields.values():
+            if isinstance(field, fields.Nested):
+                tables.update(get_nested_tables(field.schema.__class__))
+        nested_tables[serializer_class] = tables
+    return nested_tables[serializer_class]
+
+
+class CacheMixin(object):
+    """
+    Caches the response data of GET requests in `backstack.cache` for `cache_timeout` seconds, with CACHE_ENABLED.
+
+    The cache key is the compiled SQL of the queryset. The tables it reads from, the models of Nested serializer
+    fields and `cache_dependencies` (models or table names) invalidate it when they are written to.
+    Only use this when the response depends on nothing but the query, e.g. not on `request.user` in Method fields.
+
+    Without a cache, `coalesce_reads` still makes identical reads that are in flight at the same time share one query.
+    """
+    cache_timeout = None
+    cache_stale_timeout = None
+    cache_dependencies = ()
+    coalesce_reads = False
+
+    def get_cache_tables(self, query):
+        from .cache import query_tables
+        tables = query_tables(query)
+        tables.update(get_nested_tables(self.serializer_class))
+        for dependency in self.cache_dependencies:
+            tables.add(dependency if isinstance(dependency, str) else dependency.__table__.name)
+        return tables
+
+    async def cached(self, query, compute):
+        """
+        The cached result of `compute()`, which runs in an executor thread on a miss while the event loop goes on.
+        """
+        from .cache import cache, compute_in_thread, query_key
+        cache_timeout = self.cache_timeout if settings.CACHE_ENABLED else None
+        if not cache_timeout and not self.coalesce_reads:
+            return await compute_in_thread(compute)
+        key_parts = (
+            self.__class__.__module__,
+            self.__class__.__name__,
+            query_key(query),
+            self.request.query_string
+        )
+        if not cache_timeout:
+            return await cache.single_flight.do(cache.make_key(key_parts), lambda: compute_in_thread(compute))
+        return await cache.get_or_set(
+            key_parts,
+            self.get_cache_tables(query),
+            compute,
+            timeout=cache_timeout,
+            stale_timeout=self.cache_stale_timeout
+        )
+
+    async def cached_response(self, query, compute):
+        return self.conditional_response(await self.cached(query, compute))
+
+
+class ConditionalMixin(object):
+    """
+    Adds ETag and Last-Modified validators to GET responses and answers conditional requests with HTTP 304.
+
+    Validators come from `etag_column` (by default a `version` or `updated_at` column of the model) so a match is found
+    before we serialize anything. Without such a column the ETag is a hash of the rendered body, which saves
+    bandwidth but not the query.
+    Related rows rendered by Nested fields change the response too: the ETag of an item includes their own `version`
+    or `updated_at`, and falls back to the hash of the body when one of them has neither. Lists with Nested fields
+    or a custom `query` always use the hash of the body, the probe query only covers the rows of the model.
+    """
+    conditional_requests = True
+    etag_column = None
+    etag_column_names = ("version", "updated_at")
+
+    def get_model_etag_column(self, model):
+        columns = registry.get_model_info(model).column_name_set
+        for name in self.etag_column_names:
+            if name in columns:
+                return getattr(model, name)
+        return None
+
+    def get_etag_column(self):
+        if self.etag_column is not None:
+            return self.etag_column
+        return self.get_model_etag_column(self.get_model())
+
+    def has_nested_tables(self):
+        return self.serializer_class is not None and \
+            get_nested_tables(self.serializer_class) != {self.get_model().__table__.name}
+
+    def get_nested_validators(self, instance, schema, depth=3):
+        """
+        The `etag_column_names` values of the related rows that the Nested fields of a serializer render, in order,
+        or None when one of their models has no such column.
+        """
+        values = []
+        if depth == 0:
+            return values
+        for name, field in schema.fields.items():
+            if not isinstance(field, fields.Nested) or field.load_only:
+                continue
+            related = getattr(instance, field.attribute or name, None)
+            if related is None:
+                values.append(None)
+                continue
+            for row in (related if field.many else [related]):
+                column = self.get_model_etag_column(row.__class__)
+                nested = self.get_nested_validators(row, field.schema, depth - 1) if column is not None else None
+                if nested is None:
+                    return None
+                values.append(getattr(row, column.key))
+                values.extend(nested)
+        return values
+
+    def get_item_validators(self, item):
+        column = self.get_etag_column()
+        if not self.conditional_requests or column is None:
+            return None, None
+        value = getattr(item, column.key)
+        variant = self.request.query_string
+        if self.has_nested_tables():
+            nested = self.get_nested_validators(item, self.get_serializer())
+            if nested is None:
+                return None, None
+            # In the variant, so that If-Match still compares the version of the item itself, see `strip_variant`
+            variant = (variant, nested)
+        last_modified = value if isinstance(value, datetime) and not self.has_nested_tables() else None
+        return make_etag(value, variant=variant), last_modified
+
+    def get_list_probe(self):
+        """
+        A cheap query that changes whenever any row in the filtered list changes:
+        the count and max(id) catch inserts and deletes, max(timestamp) or sum(version) catches updates.
+        None with a custom `query` or grouping, whose rows may come from other tables: the ETag is then the hash of
+        the body.
+        """
+        column = self.get_etag_column()
+        if not self.conditional_requests or column is None or self.has_custom_query() or \
+                self.has_nested_tables():
+            return None
+        model = self.get_model()
+        changed = func.max(column) if isinstance(column.type, DateTime) else func.sum(column)
+        try:
+            with timed("probe"):
+                return tuple(
+                    self.get_queryset().order_by(None).with_entities(
+                        func.count(model.id), func.max(model.id), changed
+                    ).one()
+                )
+        except DataError:
+            db.session.rollback()
+            return None
+
+    def conditional_response(self, data, status=200, etag=None, last_modified=None):
+        with timed("render"):
+            resp = json_response(data, status=status)
+        if not self.conditional_requests:
+            return resp
+        if etag is None:
+            etag = make_body_etag(resp.body)
+        if is_not_modified(self.request, etag, last_modified):
+            return not_modified(etag, last_modified)
+        for k, v in validator_headers(etag, last_modified).items():
+            resp.headers[k] = v
+        return resp
+
+
+class ListMixin(CacheMixin, ConditionalMixin, QueryFilter, ModelMixin):
     """
     This mixin is used to get a list of items for a given model.
+
+    With `allow_export`, `?export=csv` streams every item that the filters select instead of a page, see
+    `handle_export`.
     """
     request = None
+    allow_export = False
+    export_formats = ("csv",)
 
     def get_list(self):
         """
@@ -141,7 +548,7 @@ class ListMixin(QueryFilter, ModelMixin):
         try:
             slice_start = ((number - 1) * size)
             slice_end = (number * size - 1)
-            return self.get_queryset()[slice_start:slice_end]
+            return self.get_loaded_queryset()[slice_start:slice_end]
         except DataError:
             db.session.rollback()
             return []
@@ -155,7 +562,40 @@ class ListMixin(QueryFilter, ModelMixin):
             self.model.id.asc()
         ]
 
+    def get_export_columns(self):
+        """
+        The columns of an export: the ones the serializer dumps, labelled with their field names, without nested
+        and computed fields. All the columns of the model when the serializer dumps none of them.
+        """
+        info = self.get_model_info()
+        columns = []
+        for name, field in self.get_serializer().fields.items():
+            attribute = field.attribute or name
+            if not field.load_only and not isinstance(field, fields.Nested) and attribute in info.column_attributes:
+                columns.append(info.column_attributes[attribute].label(name))
+        return columns or list(info.columns)
+
+    def get_export_query(self):
+        return self.get_queryset().with_entities(*self.get_export_columns())
+
+    def handle_export(self, export_format):
+        """
+        Streams the whole filtered list with a chunked response. On PostgreSQL the query runs as
+        `COPY (SELECT ...) TO STDOUT`, the rows are never loaded as objects. Memory stays bounded by EXPORT_QUEUE_SIZE
+        whatever the size of the result, see backstack.export.
+        """
+        if export_format not in self.export_formats:
+            raise ServerError({
+                "_schema": {"export": [Errors.INVALID_INPUT.value]}
+            }, status_code=400)
+        filename = "{}.{}".format(self.get_model_info().table_name, export_format)
+        from .export import csv_response
+        return csv_response(self.get_export_query().statement, filename)
+
     def handle_get(self, *args, **kwargs):
+        if self.allow_export and "export" in self.request.args:
+            return self.handle_export(self.request.args.get("export"))
+
         try:
             number = int(self.request.args.get("page[number]"), 10)
         except (ValueError, TypeError):
@@ -166,12 +606,33 @@ class ListMixin(QueryFilter, ModelMixin):
         except (ValueError, TypeError):
             size = 100
 
+        if self.cache_timeout or self.coalesce_reads:
+            return self.cached_response(self.get_queryset(), lambda: self.get_page_data(number, size))
+
+        etag = None
+        probe = self.get_list_probe()
+        if probe is not None:
+            etag = make_etag(probe, variant=self.request.query_string)
+            if is_not_modified(self.request, etag):
+                return not_modified(etag)
+
+        return self.conditional_response(
+            self.get_page_data(number, size, count=probe[0] if probe is not None else None),
+            etag=etag
+        )
+
+    def get_page_data(self, number, size, count=None):
         try:
+            if count is None:
+                with timed("count"):
+                    count = self.get_queryset().count()
+            with timed("query"):
+                items = self.get_list()
             paged_data = dict(
                 number=number,
                 size=size,
-                count=self.get_queryset().count(),
-                items=self.get_list(),
+                count=count,
+                items=items,
                 schema=self.get_serializer()
             )
         except DataError:
@@ -183,12 +644,11 @@ class ListMixin(QueryFilter, ModelMixin):
                 items=[],
                 schema=self.get_serializer()
             )
-        return response.json(
-            self.get_serializer().paginated_dump(paged_data)
-        )
+        with timed("serialize"):
+            return self.get_serializer().paginated_dump(paged_data).data
 
 
-class ViewMixin(QueryFilter, ModelMixin):
+class ViewMixin(CacheMixin, ConditionalMixin, QueryFilter, ModelMixin):
     """
     This mixin is used to get a single item for a given model.
 
@@ -196,55 +656,159 @@ class ViewMixin(QueryFilter, ModelMixin):
     """
 
     def get_item(self):
-        return self.get_queryset().one()
+        return self.get_loaded_queryset().one()
+
+    def get_item_data(self):
+        try:
+            with timed("query"):
+                item = self.get_item()
+        except NoResultFound:
+            raise NotFound()
+        with timed("serialize"):
+            return self.get_serializer().dump(item).data
 
     def handle_get(self, *args, **kwargs):
+        if self.cache_timeout or self.coalesce_reads:
+            return self.cached_response(self.get_queryset(), self.get_item_data)
+
         try:
-            return response.json(
-                self.get_serializer().dump(self.get_item())
-            )
+            with timed("query"):
+                item = self.get_item()
         except NoResultFound:
             raise NotFound()
 
+        etag, last_modified = self.get_item_validators(item)
+        if etag is not None and is_not_modified(self.request, etag, last_modified):
+            return not_modified(etag, last_modified)
+        with timed("serialize"):
+            data = self.get_serializer().dump(item).data
+        return self.conditional_response(
+            data,
+            etag=etag,
+            last_modified=last_modified
+        )
+
 
 class CreateMixin(ModelMixin):
+    """
+    Creates an instance from the JSON body of a POST.
+
+    On PostgreSQL duplicates can be handled by the INSERT itself, with `on_conflict`:
+      - "nothing": `INSERT ... ON CONFLICT DO NOTHING`, the existing row is left as it is,
+      - "update": `INSERT ... ON CONFLICT DO UPDATE`, the existing row is updated with `conflict_update_fields`,
+        by default every inserted column but the conflict and creation ones.
+    The conflict is on `conflict_target`, a unique constraint name or a list of columns, by default the first unique
+    constraint of the model. `ignore_unique_constraint_errors` is mapped to "nothing" on the ignored constraint.
+    The response is a 201 for a new row and a 200 for an existing one.
+
+    With `allow_bulk_create` the body can also be a list, which is inserted with one statement per set of keys.
+    """
     instance = None
     save_creator = True
     related_fields_to_create = None
     request = None
     ignore_unique_constraint_errors = []
+    on_conflict = None
+    conflict_target = None
+    conflict_update_fields = None
+    allow_bulk_create = False
+    max_bulk_items = 1000
+    # False when the row already existed, see `on_conflict`
+    created = True
 
     def get_insert_defaults(self):
         return {}
 
+    def get_create_events(self):
+        """
+        Events to publish once the new instance is committed, as a list of (routing key, data) tuples.
+        They are written to the outbox in the same transaction as the instance, see `backstack.outbox`.
+        """
+        return []
+
+    def get_bulk_create_events(self, rows):
+        """
+        Like `get_create_events` for the rows written by a bulk create, as dicts of column values.
+        """
+        return []
+
+    def get_upsert(self):
+        """
+        The ON CONFLICT action and columns of an insert, or None for a plain INSERT.
+        """
+        constraints = self.get_model_info().unique_constraints
+        if self.on_conflict is not None:
+            upsert.require_upsert()
+            return self.on_conflict, upsert.get_conflict_columns(constraints, self.conflict_target)
+        if self.ignore_unique_constraint_errors and upsert.supports_upsert():
+            columns = upsert.get_ignored_conflict_columns(constraints, self.ignore_unique_constraint_errors)
+            if columns is not None:
+                return upsert.DO_NOTHING, columns
+        return None
+
+    def get_insert_row(self, instance):
+        """
+        The column values that were set on an instance, keyed by column.
+        """
+        values = inspect(instance).dict
+        return {c.key: values[k] for k, c in self.get_model_info().column_attributes.items() if k in values}
+
+    def use_existing(self, conflict_columns):
+        """
+        Replaces the instance, which was not inserted, with the row that it conflicted with, found by the values of
+        the conflict columns. Raises Conflict when that row is gone by now.
+        """
+        instance = self.instance
+        values = self.get_insert_row(instance)
+        table = self.get_model().__table__
+        columns = [table.c[name] for name in conflict_columns]
+        if instance in db.session:
+            db.session.expunge(instance)
+        existing = None
+        if all(c.key in values for c in columns):
+            existing = self.get_model().query().filter(*[c == values[c.key] for c in columns]).first()
+        if existing is None:
+            db.session.rollback()
+            raise Conflict()
+        self.instance = existing
+
+    def upsert_instance(self, action, conflict_columns):
+        """
+        Inserts the instance with ON CONFLICT, then loads the returned row into it and attaches it to the session as
+        if it had been queried. With DO NOTHING and a conflict the existing row replaces the instance.
+        """
+        instance = self.instance
+        table = self.get_model().__table__
+        statement = upsert.upsert_statement(table, [self.get_insert_row(instance)], action, conflict_columns,
+                                            self.conflict_update_fields)
+        try:
+            row = db.session.execute(statement).first()
+        except IntegrityError as err:
+            # A conflict on another constraint than the target or a missing value, as in `bulk_create`
+            db.session.rollback()
+            error = integrity_error(err)
+            if isinstance(error, ModelError):
+                raise error
+            raise ServerError({"_model": error.get_error()}, status_code=400)
+        if row is None:
+            self.created = False
+            self.use_existing(conflict_columns)
+            return
+        self.created = row["inserted"]
+        if instance in db.session:
+            db.session.expunge(instance)
+        for key, column in self.get_model_info().column_attributes.items():
+            set_committed_value(instance, key, row[column])
+        make_transient_to_detached(instance)
+        db.session.add(instance)
+
     def create_related(self):
         """
         Saves related models of the model that this request is handling.
         Related models should be specified in the schema instance.
-        The foreign key relation is maintained.
-
-        Foreign key names are assumed to be ending in "_id" or "_fk"
+        The foreign key relation is maintained, see `save_related`.
         """
-        m = self.get_model()
-        fks = [c for c in m.__table__.columns.values() if c.foreign_keys]
-        for c in fks:
-            fk = list(c.foreign_keys)[0]
-            if c.name[-3:] == "_id" or c.name[-3:] == "_fk":
-                name = c.name[:-3]
-                if (name in self.related_fields_to_create and
-                        hasattr(self.instance, name) and
-                        getattr(self.instance, name, None)):
-                    fk_instance = getattr(self.instance, name)
-                    if hasattr(fk_instance, "created_from"):
-                        fk_instance.created_from = self.request.client_ip
-                    fk_instance.save(commit=False)
-                    # When we use flush, the INSERT query is sent to the
-                    # database, but session is not committed now.
-                    # The session is committed by the create_instance method
-                    # after the parent is also added to session.
-                    db.session.flush()
-                    fk_id = getattr(fk_instance, fk.column.name)
-                    setattr(self.instance, c.name, fk_id)
+        self.save_related(self.related_fields_to_create)
 
     def create_instance(self):
         instance = self.instance
@@ -262,18 +826,30 @@ class CreateMixin(ModelMixin):
         if self.related_fields_to_create and self.has_related():
             self.create_related()
 
+        upsert_args = self.get_upsert()
         try:
-            try:
-                instance.save(commit=False)
-            except UniqueConstraintError as e:
-                if e.field in self.ignore_unique_constraint_errors:
-                    pass
-            if hasattr(self, "pre_create_commit"):
+            if upsert_args is not None:
+                self.upsert_instance(*upsert_args)
+            else:
+                try:
+                    instance.save(commit=False)
+                except UniqueConstraintError as e:
+                    if e.field in self.ignore_unique_constraint_errors:
+                        self.created = False
+                        columns = upsert.get_ignored_conflict_columns(self.get_model_info().unique_constraints,
+                                                                      [e.field])
+                        if columns is not None:
+                            self.use_existing(columns)
+            # Nothing was created when the row already existed, the create hooks and events are only for new rows
+            if self.created and hasattr(self, "pre_create_commit"):
                 db.session.flush()
                 self.pre_create_commit()
 
+            if self.created:
+                enqueue_events(self.get_create_events())
             db.session.commit()
-            if hasattr(self, "post_create"):
+            bump_tables(*self.get_written_tables(self.related_fields_to_create))
+            if self.created and hasattr(self, "post_create"):
                 self.post_create()
             return True
         except AttributeError as error:
@@ -297,6 +873,8 @@ class CreateMixin(ModelMixin):
             raise ServerError()
 
     def handle_post(self, *args, **kwargs):
+        if self.allow_bulk_create and isinstance(self.request.json, list):
+            return self.handle_bulk_post(self.request.json)
         schema = self.get_serializer()
         try:
             schema_instance = schema.load(self.request.json or {})
@@ -310,9 +888,93 @@ class CreateMixin(ModelMixin):
 
         self.instance = schema_instance.data
         self.create_instance()
-        return response.json(
+        return json_response(
             schema.dump(self.instance).data,
-            status=201
+            status=201 if self.created else 200
+        )
+
+    def get_bulk_rows(self, items):
+        """
+        Validates the items of a bulk create and returns their column values with the insert defaults.
+        Related models are not created, so every field has to be a column.
+        """
+        columns = self.get_model_info().column_attributes
+        schema = self.get_serializer(raw=True)
+        try:
+            loaded = schema.load(items, many=True)
+        except ValidationError as err:
+            raise ServerError(err.messages, status_code=400)
+        if loaded.errors:
+            raise ServerError({
+                "_schema": loaded.errors
+            }, status_code=400)
+
+        defaults = self.get_insert_defaults()
+        if "created_from" in columns:
+            defaults.setdefault("created_from", self.request.client_ip)
+        if self.save_creator and "created_by_id" in columns and self.request.user:
+            defaults.setdefault("created_by_id", self.request.user.id)
+        rows = []
+        for data in loaded.data:
+            data = dict(data, **defaults)
+            for key in data:
+                if key not in columns:
+                    raise ServerError({
+                        "_schema": {key: [Errors.INVALID_INPUT.value]}
+                    }, status_code=400)
+            rows.append({columns[k].key: v for k, v in data.items()})
+        return rows
+
+    def bulk_create(self, rows):
+        """
+        Inserts rows with one statement per set of keys and returns the written rows. On PostgreSQL this is an
+        `INSERT ... RETURNING` with the ON CONFLICT of `get_upsert` (rows skipped by DO NOTHING are not returned),
+        elsewhere the rows are added with the ORM.
+        """
+        model = self.get_model()
+        upsert_args = self.get_upsert()
+        written = []
+        try:
+            if upsert.supports_upsert():
+                action, conflict_columns = upsert_args or (None, None)
+                for group in upsert.group_rows(rows):
+                    if action is None:
+                        statement = insert(model.__table__).values(group).returning(*model.__table__.columns)
+                    else:
+                        statement = upsert.upsert_statement(model.__table__, group, action, conflict_columns,
+                                                            self.conflict_update_fields)
+                    written.extend(dict(row) for row in db.session.execute(statement))
+            else:
+                instances = [model(**row) for row in rows]
+                db.session.add_all(instances)
+                db.session.flush()
+                written = [instance.as_dict() for instance in instances]
+            enqueue_events(self.get_bulk_create_events(written))
+            db.session.commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            if not upsert.supports_upsert():
+                raise ServerError()
+            error = integrity_error(err)
+            if isinstance(error, ModelError):
+                raise error
+            raise ServerError({"_model": error.get_error()}, status_code=400)
+        except (DataError, StatementError):
+            db.session.rollback()
+            raise ServerError()
+        bump_tables(model.__table__.name)
+        return written
+
+    def handle_bulk_post(self, items):
+        if not items or len(items) > self.max_bulk_items:
+            raise ServerError({
+                "_schema": {"__global__": [Errors.INVALID_INPUT.value]}
+            }, status_code=400)
+        written = self.bulk_create(self.get_bulk_rows(items))
+        created = any(row.get("inserted", True) for row in written)
+        return json_response(
+            self.get_serializer(raw=True).dump(written, many=True).data,
+            status=201 if created else 200
         )
 
 
@@ -321,46 +983,29 @@ class UpdateMixin(QueryFilter, ModelMixin):
     related_fields_to_update = None
     save_creator = True
     request = None
+    # PATCH requests without hooks are done with one UPDATE ... RETURNING, see `patch_in_place`
+    fast_patch = True
 
     def get_update_defaults(self):
         return {}
 
+    def get_update_events(self):
+        """
+        Events to publish once the instance is committed, as a list of (routing key, data) tuples.
+        They are written to the outbox in the same transaction as the update, see `backstack.outbox`.
+        """
+        return []
+
     def update_related(self):
         """
         Saves related models of the model that this request is handling.
         Related models should be specified in the schema instance.
-        The foreign key relation is maintained.
+        The foreign key relation is maintained, see `save_related`.
 
         If the related model already exists then it is updated,
         else a new instance of the related model is created.
-
-        Foreign key names are assumed to be ending in "_id" or "_fk"
         """
-        m = self.get_model()
-        fks = [c for c in m.__table__.columns.values() if c.foreign_keys]
-        for c in fks:
-            fk = list(c.foreign_keys)[0]
-            if c.name[-3:] == "_id" or c.name[-3:] == "_fk":
-                name = c.name[:-3]
-                if (name in self.related_fields_to_update and
-                        hasattr(self.instance, name) and
-                        getattr(self.instance, name, None)):
-                    # This instance may have an PK (id) in case the related
-                    # model already existed.
-                    fk_instance = getattr(self.instance, name)
-                    if hasattr(fk_instance, "created_from"):
-                        fk_instance.created_from = self.request.client_ip
-                    # SQLAlchemy will generate INSERT or UPDATE depending
-                    # on the related models existance.
-                    fk_instance.save(commit=False)
-                    # The following applies only for new related models.
-                    # When we use flush, the INSERT query is sent to the
-                    # database, but session is not committed now.
-                    # The session is committed by the create_instance method
-                    # after the parent is also added to session.
-                    db.session.flush()
-                    fk_id = getattr(fk_instance, fk.column.name)
-                    setattr(self.instance, c.name, fk_id)
+        self.save_related(self.related_fields_to_update)
 
     def update_instance(self):
         instance = self.instance
@@ -388,7 +1033,9 @@ class UpdateMixin(QueryFilter, ModelMixin):
                 db.session.flush()
                 self.pre_update_commit(instance=instance)
 
+            enqueue_events(self.get_update_events())
             db.session.commit()
+            bump_tables(*self.get_written_tables(self.related_fields_to_update))
             if hasattr(self, "post_update"):
                 self.post_update()
             return True
@@ -411,19 +1058,64 @@ class UpdateMixin(QueryFilter, ModelMixin):
             raise ServerError()
         except NoResultFound:
             raise NotFound()
+        except StaleDataError:
+            # Another request updated the row since we read it, see VersionedMixin
+            db.session.rollback()
+            raise Conflict()
+
+    def get_version_column(self):
+        """
+        The column whose value is the ETag of an item: the `version_id_col` of the model, see VersionedMixin, or
+        else the `etag_column` of ConditionalMixin.
+        """
+        info = self.get_model_info()
+        if info.version_column is not None:
+            return getattr(info.model, info.attribute_names[info.version_column])
+        if hasattr(self, "get_etag_column"):
+            return self.get_etag_column()
+        return None
+
+    def get_version_etag(self, instance):
+        column = self.get_version_column()
+        if column is None:
+            return None
+        return make_etag(getattr(instance, column.key))
+
+    def get_update_payload(self):
+        """
+        The JSON body and the version that it carries, which is removed from it: the version of a VersionedMixin model
+        is only ever written by SQLAlchemy. None when the model has no version or the body does not carry it.
+        """
+        data = self.request.json or {}
+        info = self.get_model_info()
+        if info.version_column is None or not isinstance(data, dict):
+            return data, None
+        name = info.attribute_names[info.version_column]
+        if name not in data:
+            return data, None
+        data = dict(data)
+        return data, data.pop(name)
 
     def handle_put(self, *args, **kwargs):
         try:
             existing = self.get_item()
         except NoResultFound:
             raise NotFound()
+        if not if_match(self.request, self.get_version_etag(existing)):
+            raise PreconditionFailed()
+        payload, version = self.get_update_payload()
+        if version is not None:
+            # The body is an edit of the version it carries, which someone else changed since
+            info = self.get_model_info()
+            if str(version) != str(getattr(existing, info.attribute_names[info.version_column])):
+                raise Conflict()
         if hasattr(self, "pre_update"):
-            self.pre_update(existing=existing, schema=self.get_serializer().load(self.request.json))
+            self.pre_update(existing=existing, schema=self.get_serializer().load(payload))
 
         schema = self.get_serializer(instance=existing)
 
         try:
-            schema_instance = schema.load(self.request.json or {})
+            schema_instance = schema.load(payload)
         except ValidationError as err:
             raise ServerError(message=err.messages, status_code=400)
 
@@ -434,15 +1126,276 @@ class UpdateMixin(QueryFilter, ModelMixin):
 
         self.instance = schema_instance.data
         self.update_instance()
-        return response.json(
+        etag = self.get_version_etag(self.instance)
+        return json_response(
             schema.dump(self.instance).data,
-            status=200
+            status=200,
+            headers={"ETag": etag} if etag is not None else None
+        )
+
+    def can_patch_in_place(self):
+        """
+        The single statement PATCH skips the ORM, `handle_put` and `update_instance`, so it is only used without any of
+        the update hooks, without a custom `query`, `get_queryset`, `get_item`, `get_serializer`, `handle_put` or
+        `update_instance`, without view decorators, with filters on the table of the model only and on databases
+        that support RETURNING.
+        """
+        if not self.fast_patch or self.query is not None or self.related_fields_to_update:
+            return False
+        if any(hasattr(self, hook) for hook in ("pre_update", "pre_update_commit", "post_update")):
+            return False
+        cls = self.__class__
+        if cls.get_update_events is not UpdateMixin.get_update_events or \
+                cls.get_queryset is not ModelMixin.get_queryset or \
+                cls.get_serializer is not ModelMixin.get_serializer or \
+                cls.handle_put is not UpdateMixin.handle_put or \
+                cls.update_instance is not UpdateMixin.update_instance or \
+                getattr(cls, "get_item", ViewMixin.get_item) is not ViewMixin.get_item:
+            return False
+        if getattr(self, "decorators", None):
+            return False
+        table = self.get_model().__table__
+        for condition in self.get_all_filters():
+            if any(t is not table for t in find_tables(condition, check_columns=True, include_aliases=True)):
+                return False
+        return getattr(db.engine.dialect, "implicit_returning", False)
+
+    def get_returning_columns(self, serializer):
+        """
+        The columns that the serializer dumps, labelled with their field names, or None when it dumps anything that
+        is not a column (nested schemas, methods, properties).
+        """
+        column_attributes = self.get_model_info().column_attributes
+        columns = []
+        for name, field in serializer.fields.items():
+            if field.load_only:
+                continue
+            attribute = field.attribute or name
+            if isinstance(field, fields.Nested) or attribute not in column_attributes:
+                return None
+            columns.append(column_attributes[attribute].label(attribute))
+        return columns
+
+    def patch_in_place(self):
+        """
+        Validates the payload and runs one `UPDATE ... WHERE <filters> RETURNING <serializer columns>` instead of
+        selecting the row, loading it into the ORM and flushing it.
+        Returns None when the request needs the regular path: nested data, nothing to update, a version in the body
+        or a serializer that dumps more than columns.
+        """
+        model = self.get_model()
+        info = self.get_model_info()
+        filters = self.get_all_filters()
+        serializer = self.get_serializer(raw=True)
+        returning = self.get_returning_columns(serializer)
+        payload, body_version = self.get_update_payload()
+        if not filters or returning is None or body_version is not None:
+            return None
+
+        version = self.get_version_column()
+        hashes = if_match_hashes(self.request)
+        if hashes is not None:
+            # The If-Match tags are compared in the WHERE clause, as `make_etag` would hash the version
+            if version is None or not isinstance(version.type, Integer):
+                return None
+            filters = filters + [func.md5(cast(version, Text)).in_(hashes)]
+        if version is not None:
+            returning.append(version.label("_version"))
+
+        try:
+            loaded = serializer.load(payload)
+        except ValidationError as err:
+            raise ServerError(message=err.messages, status_code=400)
+        if loaded.errors:
+            raise ServerError({
+                "_schema": loaded.errors
+            }, status_code=400)
+
+        data = dict(loaded.data, **self.get_update_defaults())
+        if not data or any(k not in info.column_attributes for k in data):
+            return None
+        values = {info.column_attributes[k].key: v for k, v in data.items()}
+        if self.save_creator and "updated_by_id" in info.column_attributes and self.request.user:
+            values["updated_by_id"] = func.coalesce(model.updated_by_id, self.request.user.id)
+        if info.version_column is not None:
+            values[info.version_column.key] = info.version_column + 1
+
+        statement = update(model.__table__).where(and_(*filters)).values(**values).returning(*returning)
+        try:
+            rows = db.session.execute(statement).fetchall()
+        except (IntegrityError, StatementError):
+            db.session.rollback()
+            raise ServerError()
+        if not rows:
+            db.session.rollback()
+            if hashes is not None and self.get_queryset().count():
+                raise PreconditionFailed()
+            raise NotFound()
+        if len(rows) > 1:
+            # The filters must identify one row, like `one()` in the regular path
+            db.session.rollback()
+            raise ServerError()
+        db.session.commit()
+        bump_tables(model.__table__.name)
+        row = dict(rows[0])
+        return json_response(
+            serializer.dump(row).data,
+            status=200,
+            headers={"ETag": make_etag(row["_version"])} if version is not None else None
         )
 
     def handle_patch(self, *args, **kwargs):
+        if self.can_patch_in_place():
+            resp = self.patch_in_place()
+            if resp is not None:
+                return resp
         return self.handle_put(*args, **kwargs)
 
 
+class DeleteMixin(QueryFilter, ModelMixin):
+    """
+    Deletes what the queryset selects with one `DELETE ... WHERE id IN (SELECT id FROM <queryset>) RETURNING id`,
+    without loading the rows. A DELETE of an item removes exactly one row and answers 204, or 404 when there is none.
+
+    With `allow_bulk_delete` a DELETE removes every row that the filters select, only the ones with the primary keys
+    of an `{"ids": [...]}` body when there is one, and answers with the number of rows. This runs in chunks of
+    `delete_chunk_size` rows, each committed on its own so that a large delete does not hold its locks for long.
+    When a chunk fails the ones before it stay deleted.
+
+    With `soft_delete_column` rows are marked instead of deleted: a Boolean column is set to true, any other to the
+    current time. Rows that are already marked are left alone, filter them out of reads with `get_default_filters`.
+    """
+    request = None
+    allow_bulk_delete = False
+    delete_chunk_size = 1000
+    max_bulk_items = 1000
+    soft_delete_column = None
+
+    def get_delete_events(self, ids):
+        """
+        Events to publish once rows are deleted, as a list of (routing key, data) tuples.
+        It is called with the primary keys of each chunk, the events are written to the outbox in its transaction.
+        """
+        return []
+
+    def get_soft_delete_column(self):
+        if self.soft_delete_column is None:
+            return None
+        return self.get_model_info().column_attributes[self.soft_delete_column]
+
+    def invalid_delete(self):
+        return ServerError({
+            "_server": {
+                "__global__": Errors.INVALID_INPUT.value,
+            },
+        }, status_code=400)
+
+    def get_delete_filters(self, ids=None):
+        """
+        The filters that `delete_rows` adds to the queryset: the primary keys of a bulk delete and what is not
+        soft deleted yet.
+        """
+        filters = []
+        if ids is not None:
+            filters.append(self.get_model_info().primary_key.in_(ids))
+        elif self.query is None and not self.get_all_filters():
+            # Never delete a whole table because a controller has no filters
+            raise self.invalid_delete()
+        column = self.get_soft_delete_column()
+        if column is not None:
+            filters.append(column.isnot(True) if isinstance(column.type, Boolean) else column.is_(None))
+        return filters
+
+    def get_delete_statement(self, where):
+        table = self.get_model().__table__
+        column = self.get_soft_delete_column()
+        if column is None:
+            return delete(table).where(where)
+        return update(table).where(where).values({column: True if isinstance(column.type, Boolean) else func.now()})
+
+    def delete_rows(self, filters, limit=None):
+        """
+        Deletes, or marks, the rows of the queryset that the filters select, at most `limit` of them, and returns
+        their primary keys. The transaction is not committed.
+        """
+        pk = self.get_model_info().primary_key
+        selected = self.get_queryset().filter(*filters).order_by(None).with_entities(pk)
+        if limit is not None:
+            selected = selected.limit(limit)
+        if getattr(db.engine.dialect, "implicit_returning", False):
+            statement = self.get_delete_statement(pk.in_(selected.subquery()))
+            return [row[0] for row in db.session.execute(statement.returning(pk))]
+        # Without RETURNING the keys are selected first, in the same transaction
+        ids = [row[0] for row in selected]
+        if ids:
+            db.session.execute(self.get_delete_statement(pk.in_(ids)))
+        return ids
+
+    def commit_deleted(self, ids):
+        enqueue_events(self.get_delete_events(ids))
+        db.session.commit()
+        bump_tables(self.get_model().__table__.name)
+
+    def get_bulk_delete_ids(self):
+        if not self.request.body:
+            return None
+        data = self.request.json
+        ids = data.get("ids", None) if isinstance(data, dict) else None
+        if not isinstance(ids, list) or not ids or len(ids) > self.max_bulk_items:
+            raise ServerError({
+                "_schema": {"ids": [Errors.INVALID_INPUT.value]}
+            }, status_code=400)
+        return ids
+
+    def handle_bulk_delete(self):
+        filters = self.get_delete_filters(self.get_bulk_delete_ids())
+        if hasattr(self, "pre_delete"):
+            self.pre_delete()
+
+        deleted = []
+        while True:
+            try:
+                ids = self.delete_rows(filters, limit=self.delete_chunk_size)
+            except (IntegrityError, StatementError):
+                db.session.rollback()
+                raise ServerError()
+            if not ids:
+                db.session.rollback()
+                break
+            self.commit_deleted(ids)
+            deleted.extend(ids)
+            if self.delete_chunk_size is None or len(ids) < self.delete_chunk_size:
+                break
+
+        if hasattr(self, "post_delete"):
+            self.post_delete(ids=deleted)
+        return json_response({"deleted": len(deleted)}, status=200)
+
+    def handle_delete(self, *args, **kwargs):
+        if self.allow_bulk_delete:
+            return self.handle_bulk_delete()
+
+        filters = self.get_delete_filters()
+        if hasattr(self, "pre_delete"):
+            self.pre_delete()
+        try:
+            ids = self.delete_rows(filters)
+        except (IntegrityError, StatementError):
+            db.session.rollback()
+            raise ServerError()
+        if not ids:
+            db.session.rollback()
+            raise NotFound()
+        if len(ids) > 1:
+            # The filters must identify one row, use `allow_bulk_delete` to delete several
+            db.session.rollback()
+            raise self.invalid_delete()
+        self.commit_deleted(ids)
+        if hasattr(self, "post_delete"):
+            self.post_delete(ids=ids)
+        return raw("", status=204)
+
+
 class CORSMixin(object):
     allowed_methods = "OPTIONS,GET,POST,PUT,PATCH,DELETE"
     allowed_headers = "Authorization,Access-Control-Allow-Headers,Origin,Accept,X-Requested-With" \
@@ -1,25 +1,43 @@
-import ujson as json
 from sqlalchemy import Column, DateTime, Integer, ForeignKey, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.dialects.postgresql import INET
 
+from .config import settings
 from .db import db, Base
+from . import json_codec
 from .errors import Errors, UniqueConstraintError, RequiredColumnError, ModelError
+from .registry import get_model_info
+
+
+def integrity_error(err):
+    """
+    The error of our own to raise for an IntegrityError from Postgres, the session must be rolled back already.
+    """
+    if (err.orig and err.orig.diag and err.orig.diag.message_primary and
+        "null value in column" in err.orig.diag.message_primary):
+        return RequiredColumnError(err.orig.diag.message_primary)
+    elif (err.orig and err.orig.diag and err.orig.diag.message_detail and
+        "is not present in table" in err.orig.diag.message_detail):
+        # 'Key (<column_name>)=(<value>) is not present in table "<related_column>".'
+        column_name = err.orig.diag.message_detail.split("=")[0]
+        column_name = column_name[column_name.find("(") + 1:-1]
+        return ModelError(field=column_name, message=Errors.INVALID_INPUT.value)
+    return UniqueConstraintError(err.orig.diag.message_detail, err.orig.diag.message_primary)
 
 
 class Serializer(object):
     __table__ = None
 
     def dump_json(self):
-        json.dumps({c.name: getattr(self, c.name) for c in self.__table__.columns})
+        return json_codec.dumps(get_model_info(self.__class__).as_dict(self))
 
 
 class Deserializer(object):
     __table__ = None
 
     def load_json(self, data):
-        column_keys = self.__table__.columns.keys()
+        column_keys = get_model_info(self.__class__).column_name_set
         for k, v in data.items():
             if k in column_keys:
                 setattr(self, k, v)
@@ -50,7 +68,7 @@ class SystemModel(Base):
         return db.session.query(cls if len(args) == 0 else args)
 
     def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return get_model_info(self.__class__).as_dict(self)
 
     def save(self, commit=True):
         db.session.add(self)
@@ -58,20 +76,32 @@ class SystemModel(Base):
         try:
             if commit:
                 db.session.commit()
+                if settings.CACHE_ENABLED:
+                    from .cache import cache
+                    cache.bump_version(self.__table__.name)
             else:
                 db.session.flush()
         except IntegrityError as err:
             db.session.rollback()
-            if (err.orig and err.orig.diag and err.orig.diag.message_primary and
-                "null value in column" in err.orig.diag.message_primary):
-                raise RequiredColumnError(err.orig.diag.message_primary)
-            elif (err.orig and err.orig.diag and err.orig.diag.message_detail and
-                "is not present in table" in err.orig.diag.message_detail):
-                # 'Key (<column_name>)=(<value>) is not present in table "<related_column>".'
-                column_name = err.orig.diag.message_detail.split("=")[0]
-                column_name = column_name[column_name.find("(") + 1:-1]
-                raise ModelError(field=column_name, message=Errors.INVALID_INPUT.value)
-            raise UniqueConstraintError(err.orig.diag.message_detail, err.orig.diag.message_primary)
+            raise integrity_error(err)
+
+
+class VersionedMixin(object):
+    """
+    Adds a `version` column that SQLAlchemy increments on every update of the row. The UPDATE is conditional on the
+    version that was read, `WHERE id = ? AND version = ?`, so concurrent updates of a row cannot overwrite each other:
+    the one that lost raises StaleDataError, which UpdateMixin answers with HTTP 409.
+    The version is also the ETag of the row, see ConditionalMixin and If-Match in UpdateMixin.
+
+        class Article(VersionedMixin, BaseModel):
+            ...
+    """
+
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {"version_id_col": cls.__table__.c.version}
 
 
 class BaseModel(SystemModel):
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+from .errors import NPlusOneError
+
+
+# The query log of the request (or `detect` block) in the current asyncio task, None when detection is off
+current_log = ContextVar("current_nplusone_log", default=None)
+# The serializer field that is being rendered, queries run meanwhile are blamed on it
+current_field = ContextVar("current_nplusone_field", default=None)
+
+
+class QueryLog(object):
+    def __init__(self):
+        # Detection is off by default, backstack.sqlstats is imported only when it is on
+        from .sqlstats import fingerprint
+        self.fingerprint = fingerprint
+        self.statements = {}
+
+    def add(self, statement, parameters, field):
+        normalized = self.fingerprint(statement)
+        if normalized not in self.statements:
+            self.statements[normalized] = dict(count=0, parameters=set(), fields=set())
+        entry = self.statements[normalized]
+        entry["count"] += 1
+        entry["parameters"].add(repr(parameters))
+        if field is not None:
+            entry["fields"].add(field)
+
+    def get_repeated(self, threshold=None):
+        """
+        Statements that ran at least `threshold` times with different parameters, which is what lazy loading
+        a relationship for every row of a list looks like.
+        """
+        threshold = threshold or settings.NPLUSONE_THRESHOLD
+        return [
+            dict(statement=normalized, count=entry["count"], fields=sorted(entry["fields"]))
+            for normalized, entry in self.statements.items()
+            if entry["count"] >= threshold and len(entry["parameters"]) > 1
+        ]
+
+
+def is_active():
+    return current_log.get() is not None
+
+
+@contextmanager
+def attributed(field):
+    """
+    Blames queries that run inside the block on a serializer field, used by our schema fields.
+    """
+    token = current_field.set("{}.{}".format(field.parent.__class__.__name__, field.name))
+    try:
+        yield
+    finally:
+        current_field.reset(token)
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    log = current_log.get()
+    if log is not None:
+        log.add(statement, parameters, current_field.get())
+
+
+def setup_detection():
+    if not event.contains(Engine, "after_cursor_execute", after_cursor_execute):
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+def describe(repeated):
+    return "\n".join(
+        "N+1 query: ran {} times{}: {}".format(
+            r["count"],
+            " (caused by {})".format(", ".join(r["fields"])) if r["fields"] else "",
+            r["statement"]
+        )
+        for r in repeated
+    )
+
+
+@contextmanager
+def detect(raise_errors=True, threshold=None):
+    """
+    Detects N+1 queries in a block of code, useful in tests:
+
+        with nplusone.detect():
+            controller.handle_get()
+
+    :raises NPlusOneError: When `raise_errors` is True and repeated statements were found
+    """
+    setup_detection()
+    log = QueryLog()
+    token = current_log.set(log)
+    try:
+        yield log
+    finally:
+        current_log.reset(token)
+    repeated = log.get_repeated(threshold)
+    if repeated:
+        if raise_errors:
+            raise NPlusOneError(repeated)
+        print(describe(repeated))
@@ -0,0 +1,76 @@
+import asyncio
+from sqlalchemy import Column, DateTime, String, Text, text
+
+from .db import db
+from .config import settings
+from .models import SystemModel
+from . import json_codec, queue
+
+
+class OutboxEvent(SystemModel):
+    """
+    An event waiting to be published to the message queue.
+
+    Events are added to the current DB session by `enqueue` so they are committed (or rolled back) together with the
+    changes that caused them. The relay (`Commands.relay_outbox`) then publishes them to RabbitMQ in batches.
+    Apps that use the outbox need the `outbox_events` table in their migrations.
+    """
+    __tablename__ = "outbox_events"
+
+    routing_key = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"))
+
+
+def enqueue(key, data):
+    """
+    Records an event in the current transaction, nothing is sent to the broker here.
+    :param str key: The routing key that the event is published with
+    :param data: JSON serializable payload of the event
+    """
+    event = OutboxEvent(routing_key=key, payload=json_codec.dumps(data))
+    db.session.add(event)
+    return event
+
+
+async def relay_batch(channel, batch_size):
+    """
+    Publishes one batch of pending events and deletes them once they are on the broker.
+
+    Rows are locked with SKIP LOCKED so that more than one relay can run at the same time.
+    Delivery is at least once: if we crash after publishing but before the commit, the batch is published again.
+    :return: The number of events published
+    """
+    events = OutboxEvent.query().\
+        order_by(OutboxEvent.id.asc()).\
+        limit(batch_size).\
+        with_for_update(skip_locked=True).\
+        all()
+    if not events:
+        db.session.rollback()
+        return 0
+
+    try:
+        for event in events:
+            await queue.publish(event.routing_key, json_codec.loads(event.payload), channel=channel)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    OutboxEvent.query().\
+        filter(OutboxEvent.id.in_([event.id for event in events])).\
+        delete(synchronize_session=False)
+    db.session.commit()
+    return len(events)
+
+
+async def relay(batch_size=None, poll_interval=None):
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    poll_interval = poll_interval or settings.OUTBOX_POLL_INTERVAL
+    channel = await queue.get_channel()
+
+    while True:
+        published = await relay_batch(channel, batch_size)
+        if published < batch_size:
+            # The outbox is drained, wait for more events
+            await asyncio.sleep(poll_interval)
@@ -0,0 +1,146 @@
+import os
+import signal
+import socket
+import sys
+import time
+
+from .config import settings
+
+
+class PreforkServer(object):
+    """
+    Runs `workers` processes of the app that share one listening socket, created here before forking.
+    The parent process only supervises the workers:
+      - a worker that dies is replaced, after a delay that grows while workers keep crashing, and the server
+        exits when they crash DAEMON_CRASH_LIMIT times within DAEMON_CRASH_WINDOW seconds,
+      - SIGHUP starts a new set of workers and then gracefully stops the old ones,
+      - SIGTERM and SIGINT gracefully stop all workers and exit.
+
+    Connections that would otherwise be shared with the parent (DB engine, memcached clients) are reset in each
+    worker by `os.register_at_fork` hooks in `db`, `session` and `cache`.
+    Workers are forked from the parent, so a reload recycles them but does not load new code.
+    """
+
+    def __init__(self, app, workers, host, port, backlog=100, **run_kwargs):
+        self.app = app
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.run_kwargs = run_kwargs
+        self.sock = None
+        # pid => generation of every running worker
+        self.children = {}
+        self.generation = 0
+        # Times of the recent crashes of workers and times at which the workers that replace them start
+        self.crashes = []
+        self.respawns = []
+        self.crash_looping = False
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        self.sock = sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Sanic installs its own handlers for SIGINT and SIGTERM, the parent's ones must not run here
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                self.app.run(sock=self.sock, workers=1, **self.run_kwargs)
+            finally:
+                os._exit(0)
+        self.children[pid] = self.generation
+        return pid
+
+    def stop_generation(self, generation, sig=signal.SIGTERM):
+        for pid, child_generation in list(self.children.items()):
+            if child_generation == generation:
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    self.children.pop(pid, None)
+
+    def reap(self):
+        """
+        Collects exited workers and replaces the ones of the current generation that died on their own.
+        """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children = {}
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            if generation == self.generation and not self.stop_requested:
+                self.schedule_respawn(pid, status)
+
+    def schedule_respawn(self, pid, status):
+        now = time.monotonic()
+        self.crashes = [t for t in self.crashes if now - t < settings.DAEMON_CRASH_WINDOW] + [now]
+        if settings.DAEMON_CRASH_LIMIT and len(self.crashes) >= settings.DAEMON_CRASH_LIMIT:
+            print("Worker {} exited with status {}, workers crashed {} times in {} seconds, stopping".format(
+                pid, status, len(self.crashes), settings.DAEMON_CRASH_WINDOW))
+            self.crash_looping = True
+            self.stop_requested = True
+            return
+        delay = min(settings.DAEMON_RESTART_DELAY * 2 ** (len(self.crashes) - 1), settings.DAEMON_RESTART_MAX_DELAY)
+        print("Worker {} exited with status {}, starting a new one in {} seconds".format(pid, status, delay))
+        self.respawns.append(now + delay)
+
+    def respawn(self):
+        now = time.monotonic()
+        due = [t for t in self.respawns if t <= now]
+        self.respawns = [t for t in self.respawns if t > now]
+        for _ in due:
+            self.spawn()
+
+    def handle_reload(self, *_):
+        self.reload_requested = True
+
+    def handle_stop(self, *_):
+        self.stop_requested = True
+
+    def run(self):
+        self.bind()
+        print("Listening on {}:{} with {} workers (pid {})".format(self.host, self.port, self.workers, os.getpid()))
+        for _ in range(self.workers):
+            self.spawn()
+
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                old_generation = self.generation
+                self.generation += 1
+                # The new generation starts with all its workers
+                self.respawns = []
+                for _ in range(self.workers):
+                    self.spawn()
+                self.stop_generation(old_generation)
+            self.reap()
+            if not self.stop_requested:
+                self.respawn()
+            time.sleep(0.2)
+
+        for generation in set(self.children.values()):
+            self.stop_generation(generation)
+        while self.children:
+            self.reap()
+            time.sleep(0.2)
+        self.sock.close()
+        if self.crash_looping:
+            sys.exit(1)
+
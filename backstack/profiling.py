@@ -0,0 +1,109 @@
+import importlib.abc
+import re
+import subprocess
+import sys
+import time
+
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)\s*$")
+
+
+class TimedLoader(importlib.abc.Loader):
+    """
+    Wraps the loader of a module to record how long executing the module took.
+    Anything else (`get_data`, `is_package`, ...) is passed to the original loader.
+    """
+
+    def __init__(self, loader, timer):
+        self.__loader = loader
+        self.__timer = timer
+
+    def create_module(self, spec):
+        return self.__loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.__timer.enter()
+        start = time.perf_counter()
+        try:
+            self.__loader.exec_module(module)
+        finally:
+            self.__timer.leave(module.__name__, time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.__loader, name)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Records the import time of every module imported while it is installed, like `python -X importtime` but for a
+    block of code in a running process:
+
+        with ImportTimer() as timer:
+            create_app()
+        timer.slowest()
+
+    Self time excludes the time spent importing other modules from the module body.
+    """
+
+    def __init__(self):
+        # module name => (self seconds, cumulative seconds)
+        self.modules = {}
+        self.__children = []
+        self.__finding = False
+
+    def find_spec(self, fullname, path, target=None):
+        if self.__finding:
+            return None
+        self.__finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self.__finding = False
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = TimedLoader(spec.loader, self)
+        return spec
+
+    def enter(self):
+        self.__children.append(0.0)
+
+    def leave(self, name, duration):
+        children = self.__children.pop()
+        self.modules[name] = (duration - children, duration)
+        if self.__children:
+            self.__children[-1] += duration
+
+    def slowest(self, limit=20):
+        return sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *_):
+        sys.meta_path.remove(self)
+
+
+def measure_imports(module="backstack", limit=20):
+    """
+    Imports `module` in a fresh interpreter with `-X importtime` and returns the slowest imports as
+    (name, self seconds, cumulative seconds), the first one being `module` itself.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is not None:
+            imports.append((match.group(3), int(match.group(1)) / 1e6, int(match.group(2)) / 1e6))
+    return sorted(imports, key=lambda i: i[2], reverse=True)[:limit]
@@ -1,9 +1,12 @@
-import ujson as json
-
 from .config import settings
+from . import codecs
 
 
-async def publish(key, data):
+async def get_channel():
+    """
+    Connects to RabbitMQ and returns a channel on which our topic exchange is declared.
+    Callers which publish many messages (like the outbox relay) should keep and reuse this channel.
+    """
     try:
         import asyncio
     except ImportError:
@@ -26,14 +29,20 @@ async def publish(key, data):
         type_name="topic",
         durable=True
     )
+    return channel
+
+
+async def publish(key, data, channel=None):
+    if channel is None:
+        channel = await get_channel()
+    payload, properties = codecs.encode(data)
+    properties["delivery_mode"] = 2
 
     # This publisher creates a queue with the durable flag and publish a message with the property persistent.
     # https://aioamqp.readthedocs.io/en/latest/examples/work_queue.html
     await channel.basic_publish(
         exchange_name=settings.get_mq_exchange_name(),
         routing_key=key,
-        payload=json.dumps(data),
-        properties={
-            'delivery_mode': 2,
-        },
+        payload=payload,
+        properties=properties,
     )
@@ -0,0 +1,83 @@
+from operator import attrgetter
+from sqlalchemy import inspect
+from sqlalchemy.orm import configure_mappers
+
+from .db import Base
+from . import json_codec, upsert
+
+
+class ModelInfo(object):
+    """
+    What the mixins and serializers need to know about a mapped class, computed once instead of on every request.
+    """
+
+    def __init__(self, model):
+        mapper = inspect(model)
+        table = model.__table__
+        self.model = model
+        self.table = table
+        self.table_name = table.name
+        self.columns = tuple(table.columns)
+        self.column_names = tuple(c.name for c in self.columns)
+        self.column_name_set = frozenset(self.column_names)
+        # Attribute name -> column, for the attributes that are mapped to a column
+        self.column_attributes = {prop.key: prop.columns[0] for prop in mapper.column_attrs}
+        # Column -> attribute name
+        self.attribute_names = {column: key for key, column in self.column_attributes.items()}
+        self.primary_key = mapper.primary_key[0]
+        self.version_column = mapper.version_id_col
+        self.relationships = {rel.key: rel.mapper.class_ for rel in mapper.relationships}
+        self.unique_constraints = upsert.get_unique_constraints(table)
+        # (column name, related attribute name, referenced column) for each foreign key column, the related
+        # attribute is the column name without its "_id" or "_fk" suffix, None for other names
+        self.foreign_keys = tuple(
+            (c.name, c.name[:-3] if c.name[-3:] in ("_id", "_fk") else None, list(c.foreign_keys)[0].column)
+            for c in self.columns if c.foreign_keys
+        )
+        self.__values = attrgetter(*(self.attribute_names.get(c, c.name) for c in self.columns))
+
+    def values(self, instance):
+        values = self.__values(instance)
+        return values if len(self.columns) > 1 else (values,)
+
+    def as_dict(self, instance):
+        return dict(zip(self.column_names, self.values(instance)))
+
+
+models = {}
+
+
+def get_model_info(model):
+    info = models.get(model)
+    if info is None:
+        info = models[model] = ModelInfo(model)
+    return info
+
+
+def build_registry(base=Base):
+    """
+    Builds the info of every class mapped on `base`, at startup once the models of the apps are imported.
+    Classes mapped later are added on first use.
+    """
+    configure_mappers()
+    for model in list(base._decl_class_registry.values()):
+        if isinstance(model, type) and getattr(model, "__table__", None) is not None:
+            get_model_info(model)
+    return len(models)
+
+
+def as_dicts(instances):
+    """
+    The column values of instances as dicts, like `as_dict` of each but with the column lookups done once per class.
+    """
+    result = []
+    info = None
+    for instance in instances:
+        if info is None or info.model is not instance.__class__:
+            info = get_model_info(instance.__class__)
+        result.append(info.as_dict(instance))
+    return result
+
+
+def dump_json(instances):
+    return json_codec.dumps(as_dicts(instances))
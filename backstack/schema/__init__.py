@@ -14,11 +14,14 @@ class SystemSchema(Schema):
     __instance__ = None
     __only__ = None
     __exclude__ = ()
+    # When raw, load returns the validated data as a dict instead of a model instance
+    __raw__ = False
 
     id = fields.Integer(dump_only=True)
 
     def __init__(self, *args, **kwargs):
         self.__instance__ = kwargs.pop("instance", None)
+        self.__raw__ = kwargs.pop("raw", False)
         self.__only__ = kwargs.get("only", None)
         self.__exclude__ = kwargs.get("exclude", ())
 
@@ -30,6 +33,8 @@ class SystemSchema(Schema):
 
     @post_load
     def make_instance(self, data):
+        if self.__raw__:
+            return data
         if hasattr(self, "Meta") and hasattr(self.Meta, "model"):
             if self.__instance__:
                 for k, v in data.items():
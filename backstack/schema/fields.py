@@ -2,6 +2,7 @@ from marshmallow import fields
 from marshmallow.exceptions import ValidationError
 
 from ..errors import Errors
+from .. import nplusone
 
 
 class Defaults:
@@ -17,6 +18,13 @@ class Defaults:
         "format": "{input} cannot be formatted as a %s." % __classname__
     }
 
+    def serialize(self, attr, obj, accessor=None):
+        if not nplusone.is_active():
+            return super().serialize(attr, obj, accessor)
+        # Reading the attribute may lazy load a relationship, so N+1 queries can be traced back to this field
+        with nplusone.attributed(self):
+            return super().serialize(attr, obj, accessor)
+
 
 class String(Defaults, fields.String):
     __classname__ = "string"
@@ -34,6 +42,8 @@ class Decimal(Defaults, fields.Decimal):
     __classname__ = "decimal"
 
     def __init__(self, *args, **kwargs):
+        # As a string, a float would lose digits, see json_codec.default
+        kwargs.setdefault("as_string", True)
         super().__init__(*args, **kwargs)
         self.default_error_messages["special"] = "Special numeric values are not permitted."
 
@@ -1,10 +1,67 @@
-import ujson as json
+import copy
+import os
 import uuid
 from pymemcache.client.base import Client
 from pymemcache.exceptions import MemcacheUnexpectedCloseError
 
 from .config import settings
 from .singleton import Singleton
+from . import json_codec
+
+
+def get_request_session_key(request):
+    """
+    The session key of a request, a new one when it has none.
+    We support both cookies and Authorization header
+    The Authorization header is useful for native apps or API consumers who may not deal with cookies
+    """
+    key = request.cookies.get(settings.SESSION_COOKIE_NAME, None) or None
+    if key is None:
+        # If the cookie does not exist in request, check if we have an Authorization header
+        auth_header = request.headers.get("authorization", None)
+        if auth_header:
+            _, key = auth_header.split(" ")
+    if key is None:
+        # If we did not get a session key at all, then we generate a new one
+        key = uuid.uuid4().hex
+    return key
+
+
+class RequestSession(object):
+    """
+    The session of one request, loaded once by the session middleware and saved by it if it changed.
+    Every request has its own, so requests that are handled at the same time (while one awaits, or in threads like
+    the sub-requests of a batch) never see or save each other's data.
+    """
+
+    def __init__(self, store, key, data):
+        self.__store = store
+        self.__key = key
+        self.__original_data = data
+        self.__data = copy.deepcopy(data)
+
+    def get_session_key(self):
+        return self.__key
+
+    def save(self):
+        self.__store.store(self.__key, self.__data)
+
+    def get(self, key, default=None):
+        return self.__data.get(key, default)
+
+    @property
+    def is_dirty(self):
+        return True if self.__original_data != self.__data else False
+
+    def __setitem__(self, key, value):
+        self.__data[key] = value
+
+    def __getitem__(self, key):
+        return self.__data[key]
+
+    def __delitem__(self, key):
+        del self.__data[key]
+        return True
 
 
 class MemcacheSession(object, metaclass=Singleton):
@@ -17,28 +74,16 @@ class MemcacheSession(object, metaclass=Singleton):
     __original_data__ = {}
     __session_data__ = {}
 
-    def set_session_key(self, request):
-        self.__session_key__ = None
-        self.__original_data__ = self.__session_data__ = {}
-
-        # We support both cookies and Authorization header
-        # The Authorization header is useful for native apps or API consumers who may not deal with cookies
-        try:
-            # Check if there is a current cookie with session key
-            if request.cookies[settings.SESSION_COOKIE_NAME]:
-                self.__session_key__ = request.cookies[settings.SESSION_COOKIE_NAME]
-        except KeyError:
-            pass
-
-        if self.__session_key__ is None:
-            # If the cookie does not exist in request, check if we have an Authorization header
-            auth_header = request.headers.get("authorization", None)
-            if auth_header:
-                _, self.__session_key__ = auth_header.split(" ")
+    def load_request_session(self, request):
+        key = get_request_session_key(request)
+        return RequestSession(self, key, self.fetch(key))
 
-        if self.__session_key__ is None:
-            # If we did not get a session key at all, then we generate a new one
-            self.__session_key__ = uuid.uuid4().hex
+    def set_session_key(self, request):
+        """
+        Loads the session of a request into this object, which is shared by the whole process.
+        Prefer `load_request_session` as soon as requests can be handled concurrently.
+        """
+        self.__session_key__ = get_request_session_key(request)
         self.load()
 
     def get_session_key(self):
@@ -49,20 +94,25 @@ class MemcacheSession(object, metaclass=Singleton):
             self.__session_client__ = Client((settings.MEMCACHED_HOST, 11211))
         return self.__session_client__
 
-    def load(self):
+    def reset_after_fork(self):
+        self.__session_client__ = None
+
+    def fetch(self, key):
         try:
-            data = self.session_store().get("sess/%s" % self.__session_key__)
+            data = self.session_store().get("sess/%s" % key)
         except MemcacheUnexpectedCloseError:
             data = None
-        if data is None:
-            self.__session_data__ = {}
-            self.__original_data__ = {}
-        else:
-            self.__session_data__ = json.loads(data)
-            self.__original_data__ = json.loads(data)
+        return {} if data is None else json_codec.loads(data)
+
+    def store(self, key, data):
+        self.session_store().set("sess/%s" % key, json_codec.dumps_bytes(data))
+
+    def load(self):
+        self.__session_data__ = self.fetch(self.__session_key__)
+        self.__original_data__ = copy.deepcopy(self.__session_data__)
 
     def save(self):
-        self.session_store().set("sess/%s" % self.__session_key__, json.dumps(self.__session_data__))
+        self.store(self.__session_key__, self.__session_data__)
 
     def get(self, key, default=None):
         try:
@@ -83,3 +133,6 @@ class MemcacheSession(object, metaclass=Singleton):
     def __delitem__(self, key):
         del self.__session_data__[key]
         return True
+
+
+os.register_at_fork(after_in_child=MemcacheSession().reset_after_fork)
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+from .json_codec import json_response
+from .metrics import current_timings, metrics_token_required
+
+
+COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|\$\d+")
+NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """
+    Normalizes a SQL statement so that statements which differ only in their parameters look the same:
+    literals and placeholders become ?, lists of them become (...) and whitespace is collapsed.
+    """
+    statement = COMMENTS.sub(" ", statement)
+    statement = STRINGS.sub("?", statement)
+    statement = PLACEHOLDERS.sub("?", statement)
+    statement = NUMBERS.sub("?", statement)
+    statement = LISTS.sub("(...)", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+
+def fingerprint_id(normalized):
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+class StatementStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.rows = 0
+        # Recent durations, enough for a p95 without keeping every call
+        self.durations = deque(maxlen=1000)
+
+    def add(self, duration, rows):
+        self.calls += 1
+        self.total_time += duration
+        self.durations.append(duration)
+        if rows is not None and rows > 0:
+            self.rows += rows
+
+    @property
+    def p95(self):
+        if not self.durations:
+            return 0.0
+        ordered = sorted(self.durations)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "total_ms": round(self.total_time * 1000, 3),
+            "mean_ms": round(self.total_time * 1000 / self.calls, 3) if self.calls else 0.0,
+            "p95_ms": round(self.p95 * 1000, 3),
+            "rows": self.rows,
+        }
+
+
+class StatementTracker(object):
+    """
+    Aggregates the statements run by this process by fingerprint and by route, like `pg_stat_statements`
+    but attributed to our controllers. Routes are known only when METRICS_ENABLED is on.
+    Statements are recorded from the handler threads (see admission) too, everything is done under a lock.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self.routes = {}
+        self.plans = {}
+        self.__last_explained = {}
+        self.__lock = threading.Lock()
+
+    def record(self, statement, duration, rows, route):
+        normalized = fingerprint(statement)
+        with self.__lock:
+            if normalized not in self.statements:
+                if len(self.statements) >= settings.SQL_STATS_MAX_STATEMENTS:
+                    return None
+                self.statements[normalized] = StatementStats()
+                self.routes[normalized] = {}
+            self.statements[normalized].add(duration, rows)
+            by_route = self.routes[normalized]
+            if route not in by_route:
+                by_route[route] = StatementStats()
+            by_route[route].add(duration, rows)
+        return normalized
+
+    def should_explain(self, normalized):
+        now = time.monotonic()
+        with self.__lock:
+            last = self.__last_explained.get(normalized, None)
+            if last is not None and now - last < settings.SLOW_QUERY_EXPLAIN_INTERVAL:
+                return False
+            self.__last_explained[normalized] = now
+        return True
+
+    def set_plan(self, normalized, plan):
+        with self.__lock:
+            # Not kept when the statistics were reset while the statement was explained
+            if normalized in self.statements:
+                self.plans[normalized] = plan
+
+    def report(self, limit=20):
+        with self.__lock:
+            top = sorted(self.statements.items(), key=lambda item: item[1].total_time, reverse=True)[:limit]
+            return [
+                dict(
+                    id=fingerprint_id(normalized),
+                    statement=normalized,
+                    plan=self.plans.get(normalized, None),
+                    routes={route or "-": stats.as_dict() for route, stats in self.routes[normalized].items()},
+                    **stats.as_dict()
+                )
+                for normalized, stats in top
+            ]
+
+    def reset(self):
+        with self.__lock:
+            self.statements = {}
+            self.routes = {}
+            self.plans = {}
+
+    def reset_after_fork(self):
+        # The lock may have been held by another thread of the parent when it forked
+        self.__lock = threading.Lock()
+
+
+tracker = StatementTracker()
+# Slow statements waiting to be explained by the explainer thread, the ones beyond its size are not explained
+explain_queue = None
+
+
+def get_explain_queue():
+    """
+    The queue of the thread that explains slow statements, started on first use in the process that runs them.
+    """
+    global explain_queue
+    if explain_queue is None:
+        explain_queue = queue.Queue(maxsize=100)
+        threading.Thread(target=explain_queued, args=(explain_queue,), name="sql-explain", daemon=True).start()
+    return explain_queue
+
+
+def explain_queued(statements):
+    while True:
+        engine, normalized, statement, parameters = statements.get()
+        tracker.set_plan(normalized, explain(engine, statement, parameters))
+
+
+def queue_explain(engine, normalized, statement, parameters):
+    try:
+        get_explain_queue().put_nowait((engine, normalized, statement, parameters))
+    except queue.Full:
+        pass
+
+
+def reset_after_fork():
+    # The explainer thread of the parent is not in the child
+    global explain_queue
+    explain_queue = None
+    tracker.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def explain(engine, statement, parameters):
+    """
+    Captures the plan of a slow SELECT, at most once per SLOW_QUERY_EXPLAIN_INTERVAL for each fingerprint, in the
+    explainer thread: the request that ran the statement does not wait for it to run a second time.
+    EXPLAIN ANALYZE runs the statement again, so it runs on a connection of its own, outside of the pool and of
+    the transaction of the request, in a read only transaction that is rolled back: a SELECT that writes (a function,
+    FOR UPDATE) fails instead of writing or locking anything.
+    """
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    try:
+        connection = engine.dialect.connect(*cargs, **cparams)
+    except Exception as e:
+        return "Could not explain: {}".format(e)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION READ ONLY")
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+        return "\n".join(row[0] for row in cursor.fetchall())
+    except Exception as e:
+        return "Could not explain: {}".format(e)
+    finally:
+        try:
+            connection.rollback()
+        finally:
+            connection.close()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("stats_query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["stats_query_start"].pop()
+    timings = current_timings.get()
+    normalized = tracker.record(
+        statement,
+        duration,
+        cursor.rowcount,
+        timings.route if timings is not None else None
+    )
+    if (normalized is not None and not executemany and
+            duration * 1000 >= settings.SLOW_QUERY_THRESHOLD and
+            conn.dialect.name == "postgresql" and
+            normalized.upper().startswith("SELECT") and
+            tracker.should_explain(normalized)):
+        queue_explain(conn.engine, normalized, statement, parameters)
+
+
+def handle_error(context):
+    # after_cursor_execute is not called for a statement that failed
+    starts = context.connection.info.get("stats_query_start", None) if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def setup_statement_tracking():
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+
+@metrics_token_required
+def sql_stats_view(request):
+    try:
+        limit = int(request.args.get("limit"), 10)
+    except (ValueError, TypeError):
+        limit = 20
+    return json_response(tracker.report(limit=limit))
@@ -0,0 +1,95 @@
+from sqlalchemy import Index, UniqueConstraint, literal_column
+
+from .db import db
+
+
+DO_NOTHING = "nothing"
+DO_UPDATE = "update"
+# Columns that keep the values of the row that was there first when an upsert updates it
+CREATION_COLUMNS = ("created_at", "created_by_id", "created_from")
+
+
+def supports_upsert():
+    return db.engine.dialect.name == "postgresql"
+
+
+def require_upsert():
+    if not supports_upsert():
+        raise Exception("INSERT ... ON CONFLICT needs PostgreSQL, see documentation for ERROR_UPSERT_REQUIREMENTS")
+
+
+def get_unique_constraints(table):
+    """
+    The unique constraints and unique indexes of a table as (name, column names) tuples, the primary key last.
+    Columns declared with unique=True have a constraint without a name, Postgres names it <table>_<column>_key.
+    """
+    constraints = []
+    for constraint in list(table.constraints) + list(table.indexes):
+        if isinstance(constraint, UniqueConstraint) or (isinstance(constraint, Index) and constraint.unique):
+            columns = [c.name for c in constraint.columns]
+            name = constraint.name or "{}_{}_key".format(table.name, "_".join(columns))
+            constraints.append((name, columns))
+    constraints.append((table.primary_key.name or "{}_pkey".format(table.name),
+                        [c.name for c in table.primary_key.columns]))
+    return constraints
+
+
+def get_conflict_columns(constraints, target=None):
+    """
+    The columns of the ON CONFLICT clause: `target` is a constraint name or a list of column names, by default the
+    first of the unique `constraints` of a table, which is its primary key when it has no other.
+    """
+    if target is None:
+        return constraints[0][1]
+    if isinstance(target, str):
+        for name, columns in constraints:
+            if name == target:
+                return columns
+        raise Exception("There is no unique constraint {}, see documentation for"
+                        " ERROR_UPSERT_REQUIREMENTS".format(target))
+    return list(target)
+
+
+def get_ignored_conflict_columns(constraints, fields):
+    """
+    The conflict columns for `ignore_unique_constraint_errors`, which lists what `UniqueConstraintError.field` would
+    be: the column of a single column constraint, the name of a multiple column one. ON CONFLICT takes one target, so
+    this is None unless exactly one constraint is ignored.
+    """
+    matched = [columns for name, columns in constraints
+               if name in fields or (len(columns) == 1 and columns[0] in fields)]
+    return matched[0] if len(matched) == 1 else None
+
+
+def upsert_statement(table, rows, action, conflict_columns, update_columns=None):
+    """
+    An `INSERT ... ON CONFLICT (conflict_columns) DO NOTHING | DO UPDATE ... RETURNING *` of one or more rows, which
+    must all have the same keys. The last returned column, `inserted`, tells a new row from an updated one.
+    Conflicting rows are not returned with DO NOTHING.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+
+    statement = insert(table).values(rows)
+    if action == DO_NOTHING:
+        statement = statement.on_conflict_do_nothing(index_elements=conflict_columns)
+    else:
+        if update_columns is None:
+            update_columns = [k for k in rows[0] if k not in conflict_columns and k not in CREATION_COLUMNS]
+        # With nothing to update the conflicting row is still locked and returned
+        update_columns = update_columns or conflict_columns[:1]
+        statement = statement.on_conflict_do_update(
+            index_elements=conflict_columns,
+            set_={k: statement.excluded[k] for k in update_columns},
+        )
+    # xmax is 0 for a row version that was inserted, an update of a conflicting row sets it
+    return statement.returning(*table.columns, literal_column("xmax = 0").label("inserted"))
+
+
+def group_rows(rows):
+    """
+    Groups rows by their keys, a multiple row INSERT needs the same columns in each row.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return list(groups.values())
@@ -0,0 +1,120 @@
+import time
+from pymemcache.exceptions import MemcacheError
+from sanic.compat import Header
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import configure_mappers
+
+from .cache import cache
+from .config import settings
+from .db import db
+from .session import MemcacheSession
+
+
+class WarmupTransport(object):
+    """
+    Stands in for the connection of a warm-up request, which is handled in process and never touches the network.
+    """
+
+    @staticmethod
+    def get_extra_info(name, default=None):
+        return default
+
+
+def open_db_connections(count):
+    """
+    Checks out `count` connections at once and returns them to the pool, so that the first requests do not pay
+    for creating the engine and connecting.
+    """
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(db.engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def open_memcached_connections():
+    cache.client().version()
+    MemcacheSession().session_store().version()
+
+
+def get_controllers(app):
+    controllers = set()
+    for route in app.router.routes_all.values():
+        view_class = getattr(route.handler, "view_class", None)
+        if view_class is not None:
+            controllers.add(view_class)
+    return controllers
+
+
+def build_serializers(app):
+    """
+    Instantiates the serializer of every registered controller, which builds its fields and nested schemas.
+    """
+    count = 0
+    for controller in get_controllers(app):
+        serializer_class = getattr(controller, "serializer_class", None)
+        if serializer_class is not None:
+            serializer_class()
+            count += 1
+    return count
+
+
+async def replay(app, url):
+    """
+    Runs a GET through the full middleware and handler stack of this process, without going through the network.
+    """
+    request = app.request_class(url.encode("utf-8"), Header({"host": "warmup"}), "1.1", "GET", WarmupTransport(), app)
+    request.body_finish()
+    responses = []
+
+    async def stream_callback(streaming_response):
+        responses.append(streaming_response)
+
+    await app.handle_request(request, responses.append, stream_callback)
+    return responses[0].status if responses else None
+
+
+def warm_up(app):
+    """
+    Opens connections and builds what the first requests of a worker would otherwise build, see `setup_warmup`.
+    A step that fails is reported and skipped, it only means that the first requests are slower.
+    """
+    start = time.perf_counter()
+    try:
+        print("Warm-up: opened {} DB connections".format(open_db_connections(settings.WARMUP_DB_CONNECTIONS)))
+    except SQLAlchemyError as e:
+        print("Warm-up: could not open DB connections:", e)
+    try:
+        open_memcached_connections()
+    except (MemcacheError, OSError) as e:
+        print("Warm-up: could not connect to memcached:", e)
+    configure_mappers()
+    print("Warm-up: built {} serializers".format(build_serializers(app)))
+    print("Warm-up: done in {:.1f}ms".format((time.perf_counter() - start) * 1000))
+
+
+def setup_warmup(app):
+    """
+    Warms up each server process before it accepts connections, then replays WARMUP_URLS once it does.
+    The process reports itself ready at /api/_ready only after that, so a load balancer that checks it sends
+    traffic to warm workers only. Called by `create_app` with WARMUP_ENABLED.
+    """
+    app.ready = False
+
+    def before_server_start(app, loop):
+        warm_up(app)
+
+    async def after_server_start(app, loop):
+        for url in settings.WARMUP_URLS:
+            try:
+                print("Warm-up: GET {} returned {}".format(url, await replay(app, url)))
+            except Exception as e:
+                print("Warm-up: GET {} failed:".format(url), e)
+        app.ready = True
+
+    app.register_listener(before_server_start, "before_server_start")
+    app.register_listener(after_server_start, "after_server_start")
+
@@ -30,7 +30,8 @@ setup(
         "marshmallow",
         "passlib",
         "aioamqp",
-        "ujson",
+        # json_codec passes `default` to ujson.dumps, which it takes since 5.2
+        "ujson>=5.2",
         "faker",
         "sanic-ipware"
     ]